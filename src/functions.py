@@ -1,6 +1,8 @@
+import itertools
+
 import numpy as np
 
-from src.preprocessing import get_color_scheme, get_dict_hash
+from src.preprocessing import get_color_scheme, get_dict_hash, get_params_key
 
 
 def filter_list_of_dicts(list1, list2):
@@ -13,6 +15,31 @@ def filter_list_of_dicts(list1, list2):
     return final_list
 
 
+class CandidateStore:
+    """compares the candidates by their codes, each code is a tuple of the keys of the candidate with the plain values
+    and the structural hashes of the nested params, so the interned params are hashed only once, the codes are made
+    for each call and no candidates are kept"""
+
+    def encode(self, candidate):
+        """returns the code of the candidate"""
+        return get_params_key(candidate)
+
+    def intersect(self, list1, list2):
+        """returns the candidates from list2, that are present in list1"""
+        codes = {self.encode(candidate) for candidate in list1}
+        return [candidate for candidate in list2 if self.encode(candidate) in codes]
+
+    def expand(self, candidate, choices):
+        """returns the copies of the candidate with all the combinations of values from choices {key: values_list}"""
+        keys = list(choices)
+        result = []
+        for values in itertools.product(*[choices[k] for k in keys]):
+            new_candidate = candidate.copy()
+            new_candidate.update(zip(keys, values))
+            result.append(new_candidate)
+        return result
+
+
 def swap_two_colors(image):
     """sawaps two colors"""
     unique = np.unique(image)
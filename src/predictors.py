@@ -1,11 +1,12 @@
 import itertools
+import multiprocessing
 import random
 
 import numpy as np
 
-from scipy import ndimage
 from scipy.stats import mode
 from src.functions import (
+    CandidateStore,
     combine_two_lists,
     filter_list_of_dicts,
     find_mosaic_block,
@@ -14,20 +15,80 @@ from src.functions import (
     swap_two_colors,
 )
 from src.preprocessing import (
-    find_color_boundaries,
+    filter_colors,
+    find_filtered_params,
     find_grid,
     get_color,
     get_color_max,
+    get_components,
     get_dict_hash,
     get_grid,
     get_mask_from_block_params,
+    get_new_blocks_sample,
     get_predict,
+    pin_caches,
     preprocess_sample,
+    unpin_caches,
 )
 from src.utils import matrix2answer
 
+# by default the candidates are split between the processes only if there are enough of them to pay for the pool,
+# params["pool_min_candidates"] changes it
+POOL_MIN_CANDIDATES = 1000
+# the predictor is shared with the forked pool processes instead of being pickled for each part of the candidates
+POOL_PREDICTOR = {}
+
+
+def verify_candidates_part(args):
+    """returns the valid candidates from the part of the shared predictor candidates"""
+    k, original_image, target_image, start, end = args
+    predictor = POOL_PREDICTOR["predictor"]
+    return predictor.verify_candidates(k, original_image, target_image, predictor.solution_candidates[start:end])
+
+
+def call_predictors_stream(predictors, stages):
+    """runs the predictors on the stages yielded by preprocess_sample_stages and returns the first result of each of
+    them, the candidates found on the previous stages gave no answer, so only the new blocks are searched on each stage,
+    the next stages are not generated after all the predictors give answers"""
+    results = [(3, None)] * len(predictors)
+    seen_params = []
+    for n, (stage, sample) in enumerate(stages):
+        # the params of the intermediate stages are filtered as the ones of the final stage will be, the final sample
+        # is already filtered
+        removed = find_filtered_params(sample) if stage != "final" else ()
+        new_blocks_sample = get_new_blocks_sample(sample, seen_params, removed)
+        for i, predictor in enumerate(predictors):
+            if results[i][0] == 0:
+                continue
+            if predictor.streamed_blocks == "new" or (predictor.streamed_blocks == "none" and n == 0):
+                results[i] = predictor(new_blocks_sample)
+            elif predictor.streamed_blocks == "all" and stage == "final":
+                results[i] = predictor(sample)
+        if all(result == 0 for result, _ in results):
+            break
+    return results
+
 
 class Predictor:
+    # the candidates of each train sample depend only on this sample, so they can be shared between the train subsets
+    shared_candidates = True
+    # the predictors with partial_verification stop predict_output at the first part different from target_image
+    partial_verification = False
+    # the predictors with target_shape_blocks use only the blocks of the shape of the train outputs
+    target_shape_blocks = False
+    # the checks of target_image made by add_candidates_list before predict_output, they compare it with the block
+    # of params[precheck_block], or with the image if params have no such block: "shape" - the output has the shape
+    # of the block, "smaller_shape" - the output is not larger than the block, "tiles" - the output is made of tiles
+    # of the shape of the block, "colors" - the output has only the colors of the block and of the color params,
+    # "pixels" - the output differs from the block only in the colors of the color params, "histogram" - the output
+    # has the same colors counts as the block
+    output_prechecks = ()
+    precheck_block = "block"
+    # the blocks searched by the predictor in call_predictors_stream: "all" - all the blocks and masks of the last
+    # stage, "new" - the train blocks added by each stage, as the candidates use one block and no masks, "none" - the
+    # predictor does not use the blocks and runs on the first stage only
+    streamed_blocks = "all"
+
     def __init__(self, params=None, preprocess_params=None):
         if params is None:
             self.params = {}
@@ -35,6 +96,8 @@ class Predictor:
             self.params = params
         self.preprocess_params = preprocess_params
         self.solution_candidates = []
+        self.candidate_store = CandidateStore()
+        self.reflect_rotate_roll_index = {}
         if "rrr_input" in self.params:
             self.rrr_input = params["rrr_input"]
         else:
@@ -42,11 +105,18 @@ class Predictor:
         if "mosaic_target" not in self.params:
             self.params["mosaic_target"] = False
 
+    def allows_target_pruning(self):
+        """returns True if the blocks that can not get the shape of the train outputs may be pruned for the
+        predictor"""
+        # the rotated or mosaic targets may have the other shape than the one used for pruning
+        return self.target_shape_blocks and not self.params["mosaic_target"] and self.params.get("rotate", 0) % 2 == 0
+
     def retrive_params_values(self, params, color_scheme):
+        colors_index = color_scheme["colors_index"]
         new_params = {}
         for k, v in params.items():
             if k[-5:] == "color":
-                new_params[k] = get_color(v, color_scheme["colors"])
+                new_params[k] = colors_index.get(get_dict_hash(v), -1)
                 if new_params[k] < 0:
                     return 1, None
             else:
@@ -54,6 +124,12 @@ class Predictor:
         return 0, new_params
 
     def reflect_rotate_roll(self, image, inverse=False):
+        """returns the reflected, rotated and rolled copy of the image, using one gather by the cached index"""
+        return np.take(image, self.get_reflect_rotate_roll_index(image.shape, inverse))
+
+    def get_reflect_rotate_roll_index(self, shape, inverse=False):
+        """returns the flat indices of the image pixels in the result of reflect_rotate_roll, they are found once for
+        each shape"""
         if self.params is not None and "reflect" in self.params:
             reflect = self.params["reflect"]
         else:
@@ -67,7 +143,11 @@ class Predictor:
         else:
             roll = (0, 0)
 
-        result = image.copy()
+        key = (shape, inverse, tuple(reflect), rotate, tuple(roll))
+        if key in self.reflect_rotate_roll_index:
+            return self.reflect_rotate_roll_index[key]
+
+        result = np.arange(np.prod(shape)).reshape(shape)
 
         if inverse:
             if reflect[0]:
@@ -86,7 +166,8 @@ class Predictor:
             if reflect[0]:
                 result = result[::-1]
 
-        return result
+        self.reflect_rotate_roll_index[key] = np.ascontiguousarray(result)
+        return self.reflect_rotate_roll_index[key]
 
     def get_images(self, k, train=True, return_target=True):
         if not train:
@@ -177,57 +258,49 @@ class Predictor:
         """ predicts 1 output image given input image and prediction params"""
         return 1, None
 
+    def precheck_output(self, image, params, target_image):
+        """returns False if the params can't give target_image, it is called before predict_output and makes the
+        checks of self.output_prechecks"""
+        if not self.output_prechecks:
+            return True
+        if self.precheck_block in params:
+            status, block = get_predict(
+                image, params[self.precheck_block], params["block_cache"], params["color_scheme"]
+            )
+            if status != 0:
+                return False
+        else:
+            block = image
+        colors = [value for key, value in params.items() if key[-5:] == "color"]
+
+        for check in self.output_prechecks:
+            if check == "shape" and block.shape != target_image.shape:
+                return False
+            if check == "smaller_shape" and (
+                target_image.shape[0] > block.shape[0] or target_image.shape[1] > block.shape[1]
+            ):
+                return False
+            if check == "tiles" and (
+                target_image.shape[0] % block.shape[0] != 0 or target_image.shape[1] % block.shape[1] != 0
+            ):
+                return False
+            if check == "colors" and not np.isin(target_image, np.concatenate([np.unique(block), colors])).all():
+                return False
+            if check == "pixels":
+                if block.shape != target_image.shape:
+                    return False
+                mask = np.logical_not(np.isin(target_image, colors))
+                if not (target_image == block)[mask].all():
+                    return False
+            if check == "histogram" and not np.array_equal(
+                np.bincount(block.ravel(), minlength=10), np.bincount(target_image.ravel(), minlength=10)
+            ):
+                return False
+        return True
+
     def filter_colors(self):
         # filtering colors, that are not present in at least one of the images
-        all_colors = []
-        for color_scheme1 in self.sample["train"]:
-            list_of_colors = [get_dict_hash(color_dict) for i in range(10) for color_dict in color_scheme1["colors"][i]]
-            all_colors.append(list_of_colors)
-        for j in range(1, len(self.sample["train"])):
-            all_colors[0] = [x for x in all_colors[0] if x in all_colors[j]]
-        keep_colors = set(all_colors[0])
-
-        for color_scheme1 in self.sample["train"]:
-            for i in range(10):
-                j = 0
-                while j < len(color_scheme1["colors"][i]):
-                    if get_dict_hash(color_scheme1["colors"][i][j]) in keep_colors:
-                        j += 1
-                    else:
-                        del color_scheme1["colors"][i][j]
-
-        delete_colors = []
-        color_scheme0 = self.sample["train"][0]
-        for i in range(10):
-            if len(color_scheme0["colors"][i]) > 1:
-                for j, color_dict1 in enumerate(color_scheme0["colors"][i][::-1][:-1]):
-                    hash1 = get_dict_hash(color_dict1)
-                    delete = True
-                    for color_dict2 in color_scheme0["colors"][i][::-1][j + 1 :]:
-                        hash2 = get_dict_hash(color_dict2)
-                        for color_scheme1 in list(self.sample["train"][1:]) + list(self.sample["test"]):
-                            found = False
-                            for k in range(10):
-                                hash_array = [get_dict_hash(color_dict) for color_dict in color_scheme1["colors"][k]]
-                                if hash1 in hash_array and hash2 in hash_array:
-                                    found = True
-                                    break
-                            if not found:
-                                delete = False
-                                break
-                        if delete:
-                            delete_colors.append(hash1)
-                            break
-
-        for color_scheme1 in self.sample["train"]:
-            for i in range(10):
-                j = 0
-                while j < len(color_scheme1["colors"][i]):
-                    if get_dict_hash(color_scheme1["colors"][i][j]) in delete_colors:
-                        del color_scheme1["colors"][i][j]
-                    else:
-                        j += 1
-        return
+        filter_colors(self.sample)
 
     def filter_sizes(self):
         if "max_size" not in self.params:
@@ -261,9 +334,18 @@ class Predictor:
         """ processes k train sample and updates self.solution_candidates"""
         return 0
 
+    def process_pinned_sample(self, k, initial=False):
+        """runs process_one_sample with the caches of k train sample pinned, so the blocks and masks it iterates are not
+        evicted by the cache budget until it returns"""
+        pin_caches(self.sample["train"][k])
+        try:
+            return self.process_one_sample(k, initial=initial)
+        finally:
+            unpin_caches(self.sample["train"][k])
+
     def process_full_train(self):
         for k in range(len(self.sample["train"])):
-            status = self.process_one_sample(k, initial=(k == 0))
+            status = self.process_pinned_sample(k, initial=(k == 0))
             if status != 0:
                 return 1
 
@@ -272,6 +354,30 @@ class Predictor:
 
         return 0
 
+    def process_train_subset(self, subset):
+        """processes the train samples with the given indices of self.initial_train like process_full_train, the
+        candidates of each first part of the subset are found once for all the subsets starting with it"""
+        prefix = ()
+        for n, k in enumerate(subset):
+            # the colors and the mosaic params are filtered for each subset, so they are a part of the key
+            prefix = prefix + (
+                (
+                    k,
+                    get_dict_hash(self.sample["train"][n]["colors"]),
+                    get_dict_hash(self.params.get("mosaic_params", {})),
+                ),
+            )
+            if prefix not in self.train_candidates:
+                # the candidates of the first sample are checked by the next ones as in process_full_train
+                self.solution_candidates = self.train_candidates.get(prefix[:-1], [])
+                status = self.process_pinned_sample(n, initial=(n == 0))
+                self.train_candidates[prefix] = self.solution_candidates if status == 0 else None
+            if self.train_candidates[prefix] is None:
+                return 1
+            self.solution_candidates = self.train_candidates[prefix]
+
+        return 0
+
     def add_candidates_list(self, image, target_image, color_scheme, params):
         old_params = params.copy()
         params = params.copy()
@@ -289,12 +395,10 @@ class Predictor:
             for all_background_color in color_iter_list:
                 final_prediction = image.copy()
                 solved = True
-                masks, n_masks = ndimage.label(image != all_background_color, structure=structure)
-                new_image_masks = [(masks == i) for i in range(1, n_masks + 1)]
-                for image_mask in new_image_masks:
-                    boundaries = find_color_boundaries(image_mask, True)
-                    new_image = image[boundaries[0] : boundaries[1] + 1, boundaries[2] : boundaries[3] + 1]
-                    new_target = target_image[boundaries[0] : boundaries[1] + 1, boundaries[2] : boundaries[3] + 1]
+                components = get_components(image, structure, "not_equal", all_background_color, params["block_cache"])
+                for box in components["boxes"]:
+                    new_image = image[box]
+                    new_target = target_image[box]
                     if "block" in params:
                         status, prediction = self.predict_output(new_image, params, block=new_image)
                     else:
@@ -302,7 +406,7 @@ class Predictor:
                     if status != 0 or prediction.shape != new_target.shape or not (prediction == new_target).all():
                         solved = False
                         break
-                    final_prediction[boundaries[0] : boundaries[1] + 1, boundaries[2] : boundaries[3] + 1] = prediction
+                    final_prediction[box] = prediction
                 if solved and final_prediction.shape == target_image.shape and (final_prediction == target_image).all():
                     params["all_background_color"] = all_background_color
                     break
@@ -312,28 +416,51 @@ class Predictor:
                 return []
 
         else:
-            status, prediction = self.predict_output(image, params)
+            if not self.precheck_output(image, params, target_image):
+                return []
+            if self.partial_verification:
+                status, prediction = self.predict_output(image, params, target_image=target_image)
+            else:
+                status, prediction = self.predict_output(image, params)
             if status != 0 or prediction.shape != target_image.shape or not (prediction == target_image).all():
                 return []
 
-        result = [old_params.copy()]
-        for k, v in params.copy().items():
-            if k[-5:] == "color":
-                temp_result = result.copy()
-                result = []
-                for dict in temp_result:
-                    for color_dict in color_scheme["colors"][v]:
-                        temp_dict = dict.copy()
-                        temp_dict[k] = color_dict
-                        result.append(temp_dict)
+        choices = {k: color_scheme["colors"][v] for k, v in params.items() if k[-5:] == "color"}
+        return self.candidate_store.expand(old_params, choices)
+
+    def verify_candidates(self, k, original_image, target_image, candidates=None):
+        """returns the candidates valid for k train sample, with params["processes"] the solution candidates are split
+        between the processes of a pool and merged in their initial order, if there are at least
+        params["pool_min_candidates"] of them"""
+        if candidates is None:
+            candidates = self.solution_candidates
+            processes = self.params.get("processes")
+            if processes and len(candidates) >= self.params.get("pool_min_candidates", POOL_MIN_CANDIDATES):
+                bounds = np.linspace(0, len(candidates), 4 * processes + 1).astype(int)
+                parts = [(k, original_image, target_image, start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+                POOL_PREDICTOR["predictor"] = self
+                try:
+                    with multiprocessing.get_context("fork").Pool(processes) as pool:
+                        results = pool.map(verify_candidates_part, parts)
+                finally:
+                    POOL_PREDICTOR.clear()
+                return [candidate for result in results for candidate in result]
 
-        return result
+        local_candidates = []
+        for candidate in candidates:
+            status, params = self.retrive_params_values(candidate, self.sample["train"][k])
+            if status != 0:
+                continue
+            local_candidates.extend(
+                self.add_candidates_list(original_image, target_image, self.sample["train"][k], params)
+            )
+        return local_candidates
 
     def update_solution_candidates(self, local_candidates, initial):
         if initial:
             self.solution_candidates = local_candidates
         else:
-            self.solution_candidates = filter_list_of_dicts(local_candidates, self.solution_candidates)
+            self.solution_candidates = self.candidate_store.intersect(local_candidates, self.solution_candidates)
         if len(self.solution_candidates) == 0:
             return 4
         else:
@@ -356,12 +483,16 @@ class Predictor:
             answers.append([])
         result_generated = False
 
-        all_subsets = list(itertools.combinations(self.initial_train, train_len))
+        all_subsets = list(itertools.combinations(range(len(self.initial_train)), train_len))
+        self.train_candidates = {}
         for subset in all_subsets:
-            self.sample["train"] = subset
+            self.sample["train"] = tuple(self.initial_train[k] for k in subset)
             if not self.init_call():
                 continue
-            status = self.process_full_train()
+            if self.shared_candidates and len(all_subsets) > 1:
+                status = self.process_train_subset(subset)
+            else:
+                status = self.process_full_train()
             if status != 0:
                 continue
 
@@ -385,13 +516,11 @@ class Predictor:
 
                         all_background_color = params["all_background_color"]
                         solved = True
-                        masks, n_masks = ndimage.label(original_image != all_background_color, structure=structure)
-                        new_image_masks = [(masks == i) for i in range(1, n_masks + 1)]
-                        for image_mask in new_image_masks:
-                            boundaries = find_color_boundaries(image_mask, True)
-                            new_image = original_image[
-                                boundaries[0] : boundaries[1] + 1, boundaries[2] : boundaries[3] + 1
-                            ]
+                        components = get_components(
+                            original_image, structure, "not_equal", all_background_color, params["block_cache"]
+                        )
+                        for box in components["boxes"]:
+                            new_image = original_image[box]
                             if "block" in params:
                                 status, prediction = self.predict_output(new_image, params, block=new_image)
                             else:
@@ -399,7 +528,7 @@ class Predictor:
                             if status != 0 or prediction.shape != new_image.shape:
                                 solved = False
                                 break
-                            result[boundaries[0] : boundaries[1] + 1, boundaries[2] : boundaries[3] + 1] = prediction
+                            result[box] = prediction
                         if not solved:
                             continue
                         prediction = result
@@ -418,6 +547,11 @@ class Predictor:
         else:
             return 3, None
 
+    def call_stream(self, stages):
+        """works like __call__ for the stages yielded by preprocess_sample_stages, the next stages are not generated
+        after the first answer"""
+        return call_predictors_stream([self], stages)[0]
+
 
 # puzzle like predictors
 class Puzzle(Predictor):
@@ -466,7 +600,9 @@ class Puzzle(Predictor):
                         )
                     )
                     if self.intersection < 0:
-                        new_grid_color = get_color(self.grid_color_list[0], color_scheme["colors"])
+                        new_grid_color = get_color(
+                            self.grid_color_list[0], color_scheme["colors"], color_scheme["colors_index"]
+                        )
                         if new_grid_color < 0:
                             return 2, None
                         predict += new_grid_color
@@ -603,7 +739,7 @@ class Puzzle(Predictor):
                 self.filter_factors(local_factors)
                 self.grid_color_list = filter_list_of_dicts(grid_color_list, self.grid_color_list)
 
-            status = self.process_one_sample(k, initial=(k == 0))
+            status = self.process_pinned_sample(k, initial=(k == 0))
             if status != 0:
                 return 1
 
@@ -700,7 +836,9 @@ class PuzzlePixel(Puzzle):
                         )
                     )
                     if self.intersection < 0:
-                        new_grid_color = get_color(self.grid_color_list[0], color_scheme["colors"])
+                        new_grid_color = get_color(
+                            self.grid_color_list[0], color_scheme["colors"], color_scheme["colors_index"]
+                        )
                         if new_grid_color < 0:
                             return 2, None
                         predict += new_grid_color
@@ -739,6 +877,11 @@ class PuzzlePixel(Puzzle):
 class Fill(Predictor):
     """applies different rules using 3x3 masks"""
 
+    target_shape_blocks = True
+    streamed_blocks = "new"
+    # only the fill and background colors are changed, so the other colors of target_image are in the block
+    output_prechecks = ("pixels",)
+
     def __init__(self, params=None, preprocess_params=None):
         super().__init__(params, preprocess_params)
         if params is not None and "pattern" in params:
@@ -909,19 +1052,18 @@ class Fill(Predictor):
                                                 original_image, target_image, self.sample["train"][k], params
                                             )
         else:
-            for candidate in self.solution_candidates:
-                status, params = self.retrive_params_values(candidate, self.sample["train"][k])
-                if status != 0:
-                    continue
-                local_candidates = local_candidates + self.add_candidates_list(
-                    original_image, target_image, self.sample["train"][k], params
-                )
+            local_candidates = self.verify_candidates(k, original_image, target_image)
         return self.update_solution_candidates(local_candidates, initial)
 
 
 class Fill3Colors(Predictor):
     """same as Fill but iterates over 3 colors"""
 
+    target_shape_blocks = True
+    streamed_blocks = "new"
+    # only the fill, second fill and background colors are changed
+    output_prechecks = ("pixels",)
+
     def __init__(self, params=None, preprocess_params=None):
         super().__init__(params, preprocess_params)
         if params is not None and "pattern" in params:
@@ -1180,19 +1322,16 @@ class Fill3Colors(Predictor):
                                                 original_image, target_image, self.sample["train"][k], params
                                             )
         else:
-            for candidate in self.solution_candidates:
-                status, params = self.retrive_params_values(candidate, self.sample["train"][k])
-                if status != 0:
-                    continue
-                local_candidates = local_candidates + self.add_candidates_list(
-                    original_image, target_image, self.sample["train"][k], params
-                )
+            local_candidates = self.verify_candidates(k, original_image, target_image)
         return self.update_solution_candidates(local_candidates, initial)
 
 
 class FillWithMask(Predictor):
     """Applies rules based on masks extracted from images"""
 
+    # only the fill and background colors are changed
+    output_prechecks = ("pixels",)
+
     def __init__(self, params=None, preprocess_params=None):
         super().__init__(params, preprocess_params)
         if params is not None and "pattern" in params:
@@ -1388,19 +1527,16 @@ class FillWithMask(Predictor):
                                                         new_params["fill_color"] = fill_color_dict
                                                         local_candidates.append(new_params)
         else:
-            for candidate in self.solution_candidates:
-                status, params = self.retrive_params_values(candidate, self.sample["train"][k])
-                if status != 0:
-                    continue
-                local_candidates = local_candidates + self.add_candidates_list(
-                    original_image, target_image, self.sample["train"][k], params
-                )
+            local_candidates = self.verify_candidates(k, original_image, target_image)
         return self.update_solution_candidates(local_candidates, initial)
 
 
 class FillPatternFound(Predictor):
     """Applies rules based on masks extracted from images"""
 
+    target_shape_blocks = True
+    streamed_blocks = "new"
+
     def predict_output(self, image, params, block=None):
         """ predicts 1 output image given input image and prediction params"""
         if block is not None:
@@ -1643,19 +1779,16 @@ class FillPatternFound(Predictor):
                                                         original_image, target_image, self.sample["train"][k], params
                                                     )
         else:
-            for candidate in self.solution_candidates:
-                status, params = self.retrive_params_values(candidate, self.sample["train"][k])
-                if status != 0:
-                    continue
-                local_candidates = local_candidates + self.add_candidates_list(
-                    original_image, target_image, self.sample["train"][k], params
-                )
+            local_candidates = self.verify_candidates(k, original_image, target_image)
         return self.update_solution_candidates(local_candidates, initial)
 
 
 class ConnectDots(Predictor):
     """connect dost of same color, on one line"""
 
+    target_shape_blocks = True
+    streamed_blocks = "new"
+
     def predict_part(self, image, params, part_type, result=None):
         if result is None:
             result = image.copy()
@@ -1740,19 +1873,16 @@ class ConnectDots(Predictor):
                                                         original_image, target_image, self.sample["train"][k], params
                                                     )
         else:
-            for candidate in self.solution_candidates:
-                status, params = self.retrive_params_values(candidate, self.sample["train"][k])
-                if status != 0:
-                    continue
-                local_candidates = local_candidates + self.add_candidates_list(
-                    original_image, target_image, self.sample["train"][k], params
-                )
+            local_candidates = self.verify_candidates(k, original_image, target_image)
         return self.update_solution_candidates(local_candidates, initial)
 
 
 class ConnectDotsAllColors(Predictor):
     """connect dost of same color, on one line"""
 
+    target_shape_blocks = True
+    streamed_blocks = "new"
+
     def predict_part(self, image, params, part_type, result=None):
         if result is None:
             result = image.copy()
@@ -1853,19 +1983,16 @@ class ConnectDotsAllColors(Predictor):
                                             if fill_self:
                                                 break
         else:
-            for candidate in self.solution_candidates:
-                status, params = self.retrive_params_values(candidate, self.sample["train"][k])
-                if status != 0:
-                    continue
-                local_candidates = local_candidates + self.add_candidates_list(
-                    original_image, target_image, self.sample["train"][k], params
-                )
+            local_candidates = self.verify_candidates(k, original_image, target_image)
         return self.update_solution_candidates(local_candidates, initial)
 
 
 class FillLines(Predictor):
     """fill the whole horizontal and/or vertical lines of one color"""
 
+    target_shape_blocks = True
+    streamed_blocks = "new"
+
     def predict_output(self, image, params, block=None):
         """ predicts 1 output image given input image and prediction params"""
         if block is not None:
@@ -1941,13 +2068,7 @@ class FillLines(Predictor):
                                                         original_image, target_image, self.sample["train"][k], params
                                                     )
         else:
-            for candidate in self.solution_candidates:
-                status, params = self.retrive_params_values(candidate, self.sample["train"][k])
-                if status != 0:
-                    continue
-                local_candidates = local_candidates + self.add_candidates_list(
-                    original_image, target_image, self.sample["train"][k], params
-                )
+            local_candidates = self.verify_candidates(k, original_image, target_image)
         return self.update_solution_candidates(local_candidates, initial)
 
 
@@ -1955,6 +2076,8 @@ class FillLines(Predictor):
 class ReconstructMosaic(Predictor):
     """reconstruct mosaic"""
 
+    streamed_blocks = "none"
+
     def __init__(self, params=None, preprocess_params=None):
         super().__init__(params, preprocess_params)
         if "simple_mode" not in self.params:
@@ -2164,6 +2287,8 @@ class ReconstructMosaic(Predictor):
 class ReconstructMosaicRR(Predictor):
     """reconstruct mosaic using rotations and reflections"""
 
+    streamed_blocks = "none"
+
     def __init__(self, params=None, preprocess_params=None):
         super().__init__(params, preprocess_params)
         if "n_rotate" not in self.params:
@@ -2476,6 +2601,10 @@ class ReconstructMosaicRRExtract(ReconstructMosaicRR):
 class Pattern(Predictor):
     """applies pattern to every pixel with particular color"""
 
+    shared_candidates = False
+    partial_verification = True
+    streamed_blocks = "none"
+
     def get_patterns(self, original_image, target_image):
         pattern_list = []
         if target_image.shape[0] % original_image.shape[0] != 0:
@@ -2518,7 +2647,7 @@ class Pattern(Predictor):
             self.additional_patterns = []
         return True
 
-    def predict_output(self, image, params):
+    def predict_output(self, image, params, target_image=None):
         if params["swap"]:
             status, new_image = swap_two_colors(image)
             if status != 0:
@@ -2534,10 +2663,27 @@ class Pattern(Predictor):
             pattern = self.all_patterns[params["pattern_num"]]
 
         size = (mask.shape[0] * pattern.shape[0], mask.shape[1] * pattern.shape[1])
+        if target_image is not None:
+            if target_image.shape != size:
+                return 5, None
+            big_mask = np.repeat(np.repeat(mask != params["inverse"], pattern.shape[0], 0), pattern.shape[1], 1)
+            if not (target_image[np.logical_not(big_mask)] == params["background_color"]).all():
+                return 7, None
         result = np.ones(size) * params["background_color"]
         for i in range(mask.shape[0]):
             for j in range(mask.shape[1]):
                 if mask[i, j] != params["inverse"]:
+                    if (
+                        target_image is not None
+                        and not (
+                            target_image[
+                                i * pattern.shape[0] : (i + 1) * pattern.shape[0],
+                                j * pattern.shape[1] : (j + 1) * pattern.shape[1],
+                            ]
+                            == pattern
+                        ).all()
+                    ):
+                        return 4, None
                     result[
                         i * pattern.shape[0] : (i + 1) * pattern.shape[0],
                         j * pattern.shape[1] : (j + 1) * pattern.shape[1],
@@ -2570,7 +2716,7 @@ class Pattern(Predictor):
                                 "swap": swap,
                             }
 
-                            status, predict = self.predict_output(original_image, params)
+                            status, predict = self.predict_output(original_image, params, target_image=target_image)
 
                             if status == 0 and (predict == target_image).all():
                                 local_candidates = local_candidates + self.add_candidates_list(
@@ -2583,6 +2729,11 @@ class Pattern(Predictor):
 class PatternFromBlocks(Pattern):
     """applies pattern extracted form some block to every pixel with particular color"""
 
+    streamed_blocks = "all"
+    # the output is the background with the copies of the pattern
+    output_prechecks = ("tiles", "colors")
+    precheck_block = "pattern"
+
     def predict_output(self, image, params, pattern=None, mask=None, target_image=None):
         if pattern is None:
             status, pattern = get_predict(
@@ -2651,7 +2802,9 @@ class PatternFromBlocks(Pattern):
                             continue
                         params = {"background_color": background_color}
 
-                        status, predict = self.predict_output(original_image, params, pattern=pattern, mask=mask)
+                        status, predict = self.predict_output(
+                            original_image, params, pattern=pattern, mask=mask, target_image=target_image
+                        )
 
                         if status == 0 and (predict == target_image).all():
                             for pattern_params in block["params"]:
@@ -2692,7 +2845,9 @@ class PatternFromBlocks(Pattern):
                     or target_image.shape[1] != pattern.shape[1] * mask.shape[1]
                 ):
                     continue
-                background_color = get_color(candidate["background_color"], color_scheme["colors"])
+                background_color = get_color(
+                    candidate["background_color"], color_scheme["colors"], color_scheme["colors_index"]
+                )
                 if background_color < 0:
                     continue
                 if not (target_image == background_color).any():
@@ -2713,6 +2868,10 @@ class PatternFromBlocks(Pattern):
 class Gravity(Predictor):
     """move non_background pixels toward something"""
 
+    streamed_blocks = "none"
+    # the pixels are moved or replaced by the color params
+    output_prechecks = ("shape", "colors")
+
     def predict_output(self, image, params):
         """ predicts 1 output image given input image and prediction params"""
         result = np.rot90(image.copy(), params["rotate"])
@@ -2779,7 +2938,11 @@ class Gravity(Predictor):
 class GravityBlocks(Predictor):
     """move non_background objects toward something"""
 
-    def get_block_mask(self, image, i, j, block_type, structure_type):
+    streamed_blocks = "none"
+    # the blocks are moved by swapping their pixels with the background ones
+    output_prechecks = ("shape", "histogram")
+
+    def get_block_mask(self, image, i, j, block_type, structure_type, store=None):
         if structure_type == 0:
             structure = [[0, 1, 0], [1, 1, 1], [0, 1, 0]]
         else:
@@ -2787,10 +2950,10 @@ class GravityBlocks(Predictor):
 
         if block_type == "same_color":
             color = image[i, j]
-            masks, n_masks = ndimage.label(image == color, structure=structure)
+            masks = get_components(image, structure, "equal", color, store)["labels"]
         elif block_type == "not_bg":
             color = image[i + 1, j]
-            masks, n_masks = ndimage.label(image != color, structure=structure)
+            masks = get_components(image, structure, "not_equal", color, store)["labels"]
 
         mask = masks == masks[i, j]
         return 0, mask
@@ -2798,6 +2961,8 @@ class GravityBlocks(Predictor):
     def predict_output(self, image, params):
         """ predicts 1 output image given input image and prediction params"""
         result = np.rot90(image.copy(), params["rotate"])
+        # the components of the intermediate images are kept only for this prediction
+        store = {}
 
         color = params["color"]
         proceed = True
@@ -2810,7 +2975,7 @@ class GravityBlocks(Predictor):
                     if result[-i, j] == color and result[-i - 1, j] != color:
                         block_color = result[-i - 1, j]
                         status, mask = self.get_block_mask(
-                            result, -i - 1, j, params["block_type"], params["structure_type"]
+                            result, -i - 1, j, params["block_type"], params["structure_type"], store
                         )
                         if status != 0:
                             continue
@@ -2856,6 +3021,9 @@ class GravityBlocks(Predictor):
 class GravityBlocksToColors(GravityBlocks):
     """move non_background objects toward some color"""
 
+    # the lines without the gravity color are filled with the color
+    output_prechecks = ("shape", "colors")
+
     def find_gravity_color(self, image, gravity_color):
         mask = image == gravity_color
         if not (mask).any():
@@ -2878,6 +3046,8 @@ class GravityBlocksToColors(GravityBlocks):
     def predict_partial_output(self, image, params):
         """ predicts 1 output image given input image and prediction params"""
         result = np.rot90(image.copy(), params["rotate"])
+        # the components of the intermediate images are kept only for this prediction
+        store = {}
 
         color = params["color"]
         proceed = True
@@ -2890,7 +3060,7 @@ class GravityBlocksToColors(GravityBlocks):
                     if result[-i, j] == color and result[-i - 1, j] != color:
                         block_color = result[-i - 1, j]
                         status, mask = self.get_block_mask(
-                            result, -i - 1, j, params["block_type"], params["structure_type"]
+                            result, -i - 1, j, params["block_type"], params["structure_type"], store
                         )
                         if status != 0:
                             continue
@@ -3047,6 +3217,10 @@ class GravityToColor(GravityBlocksToColors):
 class EliminateColor(Predictor):
     """eliminate parts of some color"""
 
+    streamed_blocks = "new"
+    # only the rows and the columns of the block are removed
+    output_prechecks = ("smaller_shape", "colors")
+
     def predict_output(self, image, params, block=None):
         """ predicts 1 output image given input image and prediction params"""
         if block is not None:
@@ -3100,19 +3274,15 @@ class EliminateColor(Predictor):
                                         original_image, target_image, self.sample["train"][k], params
                                     )
         else:
-            for candidate in self.solution_candidates:
-                status, params = self.retrive_params_values(candidate, self.sample["train"][k])
-                if status != 0:
-                    continue
-                local_candidates = local_candidates + self.add_candidates_list(
-                    original_image, target_image, self.sample["train"][k], params
-                )
+            local_candidates = self.verify_candidates(k, original_image, target_image)
         return self.update_solution_candidates(local_candidates, initial)
 
 
 class EliminateDuplicates(Predictor):
     """eliminate rows and columns if they are the same and near each other"""
 
+    streamed_blocks = "new"
+
     def predict_output(self, image, params, block=None):
         """ predicts 1 output image given input image and prediction params"""
         if block is not None:
@@ -3177,19 +3347,16 @@ class EliminateDuplicates(Predictor):
                                 if not elim_bg:
                                     break
         else:
-            for candidate in self.solution_candidates:
-                status, params = self.retrive_params_values(candidate, self.sample["train"][k])
-                if status != 0:
-                    continue
-                local_candidates = local_candidates + self.add_candidates_list(
-                    original_image, target_image, self.sample["train"][k], params
-                )
+            local_candidates = self.verify_candidates(k, original_image, target_image)
         return self.update_solution_candidates(local_candidates, initial)
 
 
 class ReplaceColumn(Predictor):
     """replace any column with another fixed column"""
 
+    shared_candidates = False
+    streamed_blocks = "none"
+
     def init_call(self):
         self.filter_colors()
         if self.params["mosaic_target"]:
@@ -3248,6 +3415,9 @@ class ReplaceColumn(Predictor):
 class CellToColumn(Predictor):
     """replace any grid cell with a fixed column"""
 
+    shared_candidates = False
+    streamed_blocks = "none"
+
     def init_call(self):
         self.filter_colors()
         if self.params["mosaic_target"]:
@@ -3323,6 +3493,8 @@ class CellToColumn(Predictor):
 class PutBlockIntoHole(Predictor):
     """moves block into rectangular zone of some color"""
 
+    streamed_blocks = "new"
+
     def predict_output(self, image, params, block=None):
         """ predicts 1 output image given input image and prediction params"""
         if block is None:
@@ -3331,10 +3503,10 @@ class PutBlockIntoHole(Predictor):
                 return 4, None
 
         if params["multiple"]:
-            masks, n_masks = ndimage.label(
-                image == params["background_color"], structure=[[0, 1, 0], [1, 1, 1], [0, 1, 0]]
+            components = get_components(
+                image, [[0, 1, 0], [1, 1, 1], [0, 1, 0]], "equal", params["background_color"], params["block_cache"]
             )
-            masks = [masks == i for i in range(1, n_masks + 1)]
+            masks = [components["labels"] == i for i in range(1, components["n"] + 1)]
         else:
             masks = [image == params["background_color"]]
 
@@ -3436,19 +3608,15 @@ class PutBlockIntoHole(Predictor):
                                                     original_image, target_image, self.sample["train"][k], params
                                                 )
         else:
-            for candidate in self.solution_candidates:
-                status, params = self.retrive_params_values(candidate, self.sample["train"][k])
-                if status != 0:
-                    continue
-                local_candidates = local_candidates + self.add_candidates_list(
-                    original_image, target_image, self.sample["train"][k], params
-                )
+            local_candidates = self.verify_candidates(k, original_image, target_image)
         return self.update_solution_candidates(local_candidates, initial)
 
 
 class PutBlockOnPixel(Predictor):
     """replace particular color pixels with some blocks"""
 
+    streamed_blocks = "new"
+
     def predict_output(self, image, params, block=None):
         """ predicts 1 output image given input image and prediction params"""
         if block is None:
@@ -3539,19 +3707,15 @@ class PutBlockOnPixel(Predictor):
                                                     original_image, target_image, self.sample["train"][k], params
                                                 )
         else:
-            for candidate in self.solution_candidates:
-                status, params = self.retrive_params_values(candidate, self.sample["train"][k])
-                if status != 0:
-                    continue
-                local_candidates = local_candidates + self.add_candidates_list(
-                    original_image, target_image, self.sample["train"][k], params
-                )
+            local_candidates = self.verify_candidates(k, original_image, target_image)
         return self.update_solution_candidates(local_candidates, initial)
 
 
 class EliminateBlock(Predictor):
     """replace blocks with some background color"""
 
+    streamed_blocks = "new"
+
     def predict_output(self, image, params, block=None):
         """ predicts 1 output image given input image and prediction params"""
         if block is None:
@@ -3639,19 +3803,15 @@ class EliminateBlock(Predictor):
                                             original_image, target_image, self.sample["train"][k], params
                                         )
         else:
-            for candidate in self.solution_candidates:
-                status, params = self.retrive_params_values(candidate, self.sample["train"][k])
-                if status != 0:
-                    continue
-                local_candidates = local_candidates + self.add_candidates_list(
-                    original_image, target_image, self.sample["train"][k], params
-                )
+            local_candidates = self.verify_candidates(k, original_image, target_image)
         return self.update_solution_candidates(local_candidates, initial)
 
 
 class InsideBlock(Predictor):
     """cut off the outer pixels of the block"""
 
+    streamed_blocks = "new"
+
     def predict_output(self, image, params):
         """ predicts 1 output image given input image and prediction params"""
 
@@ -3727,7 +3887,7 @@ class MaskToBlock(Predictor):
             )
             if status != 0:
                 return status, None
-            color = get_color(color_param, params["color_scheme"]["colors"])
+            color = get_color(color_param, params["color_scheme"]["colors"], params["color_scheme"]["colors_index"])
             if color < 0:
                 return 6, None
             status, result = self.apply_mask(result, mask, color)
@@ -3898,6 +4058,8 @@ class MaskToBlock(Predictor):
 class Colors(Predictor):
     """returns colors as answers"""
 
+    streamed_blocks = "none"
+
     def predict_output(self, image, params):
         if params["type"] == "one":
             return 0, np.array([[params["color"]]])
@@ -4061,6 +4223,9 @@ class Colors(Predictor):
 class ExtendTargets(Predictor):
     """creates prediction based on targets mostly"""
 
+    shared_candidates = False
+    streamed_blocks = "none"
+
     def init_call(self):
         self.filter_colors()
         if self.params["mosaic_target"]:
@@ -4159,6 +4324,8 @@ class ExtendTargets(Predictor):
 class ImageSlicer(Predictor):
     """divde image into several ones and apply aotheer predictors to each one"""
 
+    streamed_blocks = "none"
+
     def __init__(self, params=None, preprocess_params=None):
         super().__init__(params, preprocess_params)
         self.predictors = [
@@ -4278,7 +4445,7 @@ class MaskToBlockParallel(Predictor):
             )
             if status != 0:
                 return status, None
-            color = get_color(color_param, params["color_scheme"]["colors"])
+            color = get_color(color_param, params["color_scheme"]["colors"], params["color_scheme"]["colors_index"])
             if color < 0:
                 return 6, None
             status, result = self.apply_mask(result, mask, color)
@@ -4421,6 +4588,8 @@ class MaskToBlockParallel(Predictor):
 class RotateAndCopyBlock(Predictor):
     """rotates an copies initial block"""
 
+    streamed_blocks = "new"
+
     def predict_output(self, image, params, block=None, target_image=None):
         """ predicts 1 output image given input image and prediction params"""
         if block is None:
@@ -4483,11 +4652,5 @@ class RotateAndCopyBlock(Predictor):
                                             original_image, target_image, self.sample["train"][k], params
                                         )
         else:
-            for candidate in self.solution_candidates:
-                status, params = self.retrive_params_values(candidate, self.sample["train"][k])
-                if status != 0:
-                    continue
-                local_candidates = local_candidates + self.add_candidates_list(
-                    original_image, target_image, self.sample["train"][k], params
-                )
+            local_candidates = self.verify_candidates(k, original_image, target_image)
         return self.update_solution_candidates(local_candidates, initial)
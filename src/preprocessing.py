@@ -1,11 +1,16 @@
+import hashlib
 import json
+import multiprocessing
+import os
+import pickle
 import time
+import weakref
 
 import numpy as np
 
+from numpy.lib.stride_tricks import as_strided
 from scipy import ndimage
 from scipy.stats import mode
-from src.utils import matrix2answer
 
 
 def find_grid(image, frame=False, possible_colors=None):
@@ -160,6 +165,50 @@ def get_transpose(image):
     return 0, np.transpose(image)
 
 
+def get_dihedral(image, k=0, transpose=False):
+    """returns the image rotated k times and then transposed"""
+    result = np.rot90(image, k)
+    if transpose:
+        result = np.transpose(result)
+    return 0, result
+
+
+def get_dihedral_product():
+    """returns the table of the dihedral elements equal to applying g and then h"""
+    elements = [(k, transpose) for transpose in [False, True] for k in range(4)]
+    image = np.arange(6).reshape(2, 3)
+    images = [get_dihedral(image, *element)[1] for element in elements]
+    product = {}
+    for g, image_g in zip(elements, images):
+        for h in elements:
+            image_gh = get_dihedral(image_g, *h)[1]
+            product[(g, h)] = [
+                e
+                for e, image_e in zip(elements, images)
+                if image_e.shape == image_gh.shape and (image_e == image_gh).all()
+            ][0]
+    return product
+
+
+DIHEDRAL_PRODUCT = get_dihedral_product()
+
+
+def get_dihedral_image(orbits, key, image, element):
+    """returns the hash and the array of the dihedral element applied to the image,
+    each image of the orbit is computed and hashed only once"""
+    if key not in orbits:
+        orbits[key] = ({(0, False): (key, np.ascontiguousarray(image))}, (0, False))
+    images, g = orbits[key]
+    element = DIHEDRAL_PRODUCT[(g, element)]
+    if element not in images:
+        block = np.ascontiguousarray(get_dihedral(images[(0, False)][1], *element)[1])
+        block_hash = get_array_hash(block)
+        images[element] = (block_hash, block)
+        if block_hash not in orbits:
+            orbits[block_hash] = (images, element)
+    return images[element]
+
+
 def get_roll(image, shift, axis):
     return 0, np.roll(image, shift=shift, axis=axis)
 
@@ -285,6 +334,84 @@ def get_color_swap(image, color_1, color_2):
     return 0, result
 
 
+def get_dihedral_commutation():
+    """returns the tables of the sides of cuts and reflections, which give the same result when they are applied
+    before the dihedral element instead of after it"""
+    elements = [(k, transpose) for transpose in [False, True] for k in range(4)]
+    image = np.arange(12).reshape(3, 4)
+    cuts = {side: {x: int(x == side) for x in "lrtb"} for side in "lrtb"}
+    reflect_sides = ["r", "l", "t", "b", "rt", "rb", "lt", "lb"]
+
+    def find_side(sides, block, transform, element):
+        for side in sides:
+            block_g = get_dihedral(transform(side), *element)[1]
+            if block_g.shape == block.shape and (block_g == block).all():
+                return side
+
+    cut_table, reflect_table = {}, {}
+    for element in elements:
+        image_g = get_dihedral(image, *element)[1]
+        for side in "lrtb":
+            block = get_cut_edge(image_g, **cuts[side])[1]
+            cut_table[(element, side)] = find_side("lrtb", block, lambda x: get_cut_edge(image, **cuts[x])[1], element)
+        for side in reflect_sides:
+            block = get_reflect(image_g, side)[1]
+            reflect_table[(element, side)] = find_side(reflect_sides, block, lambda x: get_reflect(image, x)[1], element)
+    return cut_table, reflect_table
+
+
+CUT_SIDES, REFLECT_SIDES = get_dihedral_commutation()
+
+
+def get_dihedral_steps(element):
+    """returns the canonical transforms of the dihedral element"""
+    steps = []
+    if element[0] != 0:
+        steps.append(intern_params({"type": "rotation", "k": element[0]}))
+    if element[1]:
+        steps.append(intern_params({"type": "transpose"}))
+    return steps
+
+
+def append_step(params, step):
+    """returns the canonical form of params followed by step, params must be canonical: the rotations and transposes
+    are merged and moved after the cuts of edges, reflections, resizes and color swaps, the adjacent cuts of edges
+    are merged"""
+    params = list(params)
+    element = (0, False)
+    # the canonical chain ends with at most one rotation and one transpose
+    while params and params[-1]["type"] in ["rotation", "transpose"]:
+        last = params.pop()
+        last = (last["k"] % 4, False) if last["type"] == "rotation" else (0, True)
+        element = DIHEDRAL_PRODUCT[(last, element)]
+
+    if step["type"] in ["rotation", "transpose"]:
+        step = (step["k"] % 4, False) if step["type"] == "rotation" else (0, True)
+        return params + get_dihedral_steps(DIHEDRAL_PRODUCT[(element, step)])
+
+    if step["type"] == "cut_edge":
+        sides = {CUT_SIDES[(element, side)]: step[side] for side in "lrtb"}
+        if params and params[-1]["type"] == "cut_edge":
+            previous = params.pop()
+            sides = {side: sides[side] + previous[side] for side in "lrtb"}
+        step = intern_params({"type": "cut_edge", "l": sides["l"], "r": sides["r"], "t": sides["t"], "b": sides["b"]})
+    elif step["type"] == "reflect":
+        step = intern_params({"type": "reflect", "side": REFLECT_SIDES[(element, step["side"])]})
+    elif not (
+        step["type"] in ["resize", "color_swap"] or (step["type"] == "resize_to" and step["size_x"] == step["size_y"])
+    ):
+        return params + get_dihedral_steps(element) + [step]
+    return params + [step] + get_dihedral_steps(element)
+
+
+def normalize_params(params):
+    """returns the canonical form of the chain of transforms"""
+    result = []
+    for step in params:
+        result = append_step(result, step)
+    return intern_params(result)
+
+
 def get_cut(image, x1, y1, x2, y2):
     if x1 >= x2 or y1 >= y2:
         return 1, None
@@ -292,131 +419,149 @@ def get_cut(image, x1, y1, x2, y2):
         return 0, image[x1:x2, y1:y2]
 
 
-def get_min_block(image, full=True):
+def get_components(image, structure, rule="nonzero", color=None, store=None):
+    """returns the connected components index of the image, it is computed once per (image, structure, rule) and
+    kept in the blocks store of the image, so it lives as long as the sample"""
+    if store is not None:
+        cache = store.setdefault("components", {})
+        key = (get_array_hash(image), tuple(map(tuple, structure)), rule, color)
+        if key in cache:
+            return cache[key]
+
+    if rule == "nonzero":
+        foreground = image
+    elif rule == "equal":
+        foreground = image == color
+    else:
+        foreground = image != color
+    labels, n_labels = ndimage.label(foreground, structure=structure)
+    labels.flags.writeable = False
+
+    colors_num = max(10, int(image.max()) + 1)
+    histograms = np.bincount(
+        (labels.ravel() * colors_num + image.ravel()).astype(np.int64), minlength=(n_labels + 1) * colors_num
+    ).reshape(n_labels + 1, colors_num)[1:]
+
+    components = {
+        "labels": labels,
+        "n": n_labels,
+        "sizes": np.bincount(labels.ravel(), minlength=n_labels + 1)[1:],
+        "boxes": ndimage.find_objects(labels),
+        "histograms": histograms,
+    }
+
+    if store is not None:
+        cache[key] = components
+    return components
+
+
+def get_min_block(image, full=True, store=None):
     if full:
         structure = [[1, 1, 1], [1, 1, 1], [1, 1, 1]]
     else:
         structure = [[0, 1, 0], [1, 1, 1], [0, 1, 0]]
-    masks, n_masks = ndimage.label(image, structure=structure)
-    sizes = [(masks == i).sum() for i in range(1, n_masks + 1)]
+    components = get_components(image, structure, store=store)
 
-    if n_masks == 0:
+    if components["n"] == 0:
         return 2, None
 
-    min_n = np.argmin(sizes) + 1
-
-    boundaries = find_color_boundaries(masks, min_n)
-    if boundaries:
-        return (0, image[boundaries[0] : boundaries[1] + 1, boundaries[2] : boundaries[3] + 1])
-    else:
-        return 1, None
+    return 0, image[components["boxes"][np.argmin(components["sizes"])]]
 
 
-def get_min_block_mask(image, full=True):
+def get_min_block_mask(image, full=True, store=None):
     if full:
         structure = [[1, 1, 1], [1, 1, 1], [1, 1, 1]]
     else:
         structure = [[0, 1, 0], [1, 1, 1], [0, 1, 0]]
-    masks, n_masks = ndimage.label(image, structure=structure)
-    sizes = [(masks == i).sum() for i in range(1, n_masks + 1)]
+    components = get_components(image, structure, store=store)
 
-    if n_masks == 0:
+    if components["n"] == 0:
         return 2, None
 
-    min_n = np.argmin(sizes) + 1
-    return 0, masks == min_n
+    min_n = np.argmin(components["sizes"]) + 1
+    return 0, components["labels"] == min_n
 
 
-def get_max_block_mask(image, full=True):
+def get_max_block_mask(image, full=True, store=None):
     if full:
         structure = [[1, 1, 1], [1, 1, 1], [1, 1, 1]]
     else:
         structure = [[0, 1, 0], [1, 1, 1], [0, 1, 0]]
-    masks, n_masks = ndimage.label(image, structure=structure)
-    sizes = [(masks == i).sum() for i in range(1, n_masks + 1)]
+    components = get_components(image, structure, store=store)
 
-    if n_masks == 0:
+    if components["n"] == 0:
         return 2, None
 
-    min_n = np.argmax(sizes) + 1
-    return 0, masks == min_n
+    max_n = np.argmax(components["sizes"]) + 1
+    return 0, components["labels"] == max_n
 
 
-def get_max_block(image, full=True):
+def get_max_block(image, full=True, store=None):
     if full:
         structure = [[1, 1, 1], [1, 1, 1], [1, 1, 1]]
     else:
         structure = [[0, 1, 0], [1, 1, 1], [0, 1, 0]]
-    masks, n_masks = ndimage.label(image, structure=structure)
-    sizes = [(masks == i).sum() for i in range(1, n_masks + 1)]
+    components = get_components(image, structure, store=store)
 
-    if n_masks == 0:
+    if components["n"] == 0:
         return 2, None
 
-    max_n = np.argmax(sizes) + 1
+    return 0, image[components["boxes"][np.argmax(components["sizes"])]]
 
-    boundaries = find_color_boundaries(masks, max_n)
-    if boundaries:
-        return (0, image[boundaries[0] : boundaries[1] + 1, boundaries[2] : boundaries[3] + 1])
-    else:
-        return 1, None
 
-
-def get_block_with_side_colors(image, block_type="min", structure=0):
+def get_block_with_side_colors(image, block_type="min", structure=0, store=None):
     if structure == 0:
         structure = [[1, 1, 1], [1, 1, 1], [1, 1, 1]]
     else:
         structure = [[0, 1, 0], [1, 1, 1], [0, 1, 0]]
-    masks, n_masks = ndimage.label(image, structure=structure)
+    components = get_components(image, structure, store=store)
 
-    if n_masks == 0:
+    if components["n"] == 0:
         return 2, None
 
-    unique_nums = []
-    for i in range(1, n_masks + 1):
-        unique = np.unique(image[masks == i])
-        unique_nums.append(len(unique))
+    unique_nums = (components["histograms"] > 0).sum(axis=1)
 
     if block_type == "min":
-        n = np.argmin(unique_nums) + 1
+        n = np.argmin(unique_nums)
     else:
-        n = np.argmax(unique_nums) + 1
+        n = np.argmax(unique_nums)
 
-    boundaries = find_color_boundaries(masks, n)
-    if boundaries:
-        return (0, image[boundaries[0] : boundaries[1] + 1, boundaries[2] : boundaries[3] + 1])
-    else:
-        return 1, None
+    return 0, image[components["boxes"][n]]
 
 
-def get_block_with_side_colors_count(image, block_type="min", structure=0):
+def get_block_with_side_colors_count(image, block_type="min", structure=0, store=None):
     if structure == 0:
         structure = [[1, 1, 1], [1, 1, 1], [1, 1, 1]]
     else:
         structure = [[0, 1, 0], [1, 1, 1], [0, 1, 0]]
-    masks, n_masks = ndimage.label(image, structure=structure)
-    if n_masks == 0:
+    components = get_components(image, structure, store=store)
+    if components["n"] == 0:
         return 2, None
 
-    unique_nums = []
-    for i in range(1, n_masks + 1):
-        unique, counts = np.unique(image[masks == i], return_counts=True)
-        unique_nums.append(min(counts))
+    histograms = components["histograms"]
+    unique_nums = np.where(histograms > 0, histograms, histograms.max() + 1).min(axis=1)
 
     if block_type == "min":
-        n = np.argmin(unique_nums) + 1
+        n = np.argmin(unique_nums)
     else:
-        n = np.argmax(unique_nums) + 1
+        n = np.argmax(unique_nums)
 
-    boundaries = find_color_boundaries(masks, n)
-    if boundaries:
-        return (0, image[boundaries[0] : boundaries[1] + 1, boundaries[2] : boundaries[3] + 1])
-    else:
-        return 1, None
+    return 0, image[components["boxes"][n]]
 
 
-def get_color(color_dict, colors):
+def get_colors_index(colors):
+    """returns the dict from the hashes of color descriptors to the first color they describe"""
+    colors_index = {}
+    for i, color in enumerate(colors):
+        for data in color:
+            colors_index.setdefault(get_dict_hash(data), i)
+    return colors_index
+
+
+def get_color(color_dict, colors, colors_index=None):
     """ retrive the absolute number corresponding a color set by color_dict"""
+    if colors_index is not None:
+        return colors_index.get(get_dict_hash(color_dict), -1)
     for i, color in enumerate(colors):
         for data in color:
             equal = True
@@ -563,20 +708,181 @@ def get_color_scheme(image, target_image=None, params=None):
             result["grid_frame"] = frame
             result["colors"][grid_color].append({"type": "grid"})
 
+    result["colors"] = [[intern_params(color_dict) for color_dict in color_list] for color_list in result["colors"]]
+    result["colors_index"] = get_colors_index(result["colors"])
     return result
 
 
-def add_block(target_dict, image, params_list):
-    array_hash = hash(matrix2answer(image))
+def create_block_store():
+    """returns an empty store for blocks or masks"""
+    return {"arrays": {}, "params": {}}
+
+
+def get_array_hash(image):
+    """returns the key of the array based on its shape and raw bytes"""
+    array = np.ascontiguousarray(image, dtype=np.uint8)
+    return get_bytes_hash(array.shape, array.tobytes())
+
+
+def get_bytes_hash(shape, data):
+    """returns the key of the array with the given shape and uint8 bytes"""
+    digest = hashlib.blake2b((",".join(map(str, shape)) + ";").encode() + data, digest_size=8)
+    return int.from_bytes(digest.digest(), "little", signed=True)
+
+
+def add_block(target_dict, image, params_list, array_hash=None):
+    if array_hash is None:
+        array_hash = get_array_hash(image)
     if array_hash not in target_dict["arrays"]:
-        target_dict["arrays"][array_hash] = {"array": image, "params": []}
+        target_dict["arrays"][array_hash] = {"array": np.ascontiguousarray(image), "params": []}
 
     for params in params_list:
-        params_hash = get_dict_hash(params)
+        params = intern_params(params)
+        params_hash = params.hash
+        # the repeated color descriptors, such as unique/left, give the same chains
+        if params_hash in target_dict["params"]:
+            continue
         target_dict["arrays"][array_hash]["params"].append(params)
         target_dict["params"][params_hash] = array_hash
 
 
+# the memory taken by the memoized failure of params, which has no array
+FAILURE_BYTES = 64
+
+
+def limit_sample_caches(samples, max_bytes):
+    """limits the arrays and failures added to the blocks and masks of all the samples after the preprocessing to
+    max_bytes in total, the least recently used of them are evicted first"""
+    budget = {"max_bytes": max_bytes, "bytes": 0, "evicted": 0, "entries": {}, "pinned": {}}
+    for sample in samples:
+        for item in sample["train"] + sample["test"]:
+            for key in ["blocks", "masks"]:
+                if key in item:
+                    # the store keeps its budget if it is shared by several samples
+                    item[key].setdefault("lru", budget)
+    return budget
+
+
+def charge_cache_entry(store, key, size):
+    """charges the new entry of the store to the budget of the store, the least recently used entries are evicted
+    if the budget is exceeded"""
+    budget = store.get("lru")
+    if budget is None:
+        return
+    budget["entries"][(id(store), key)] = store
+    budget["bytes"] += size
+    evict_cache_entries(budget)
+
+
+def evict_cache_entries(budget):
+    """evicts the least recently used entries while the budget is exceeded, the entries of the pinned stores are put
+    aside until their stores are unpinned"""
+    entries, pinned = budget["entries"], budget["pinned"]
+    while budget["bytes"] > budget["max_bytes"] and entries:
+        (store_id, key), store = next(iter(entries.items()))
+        if store_id in pinned:
+            del entries[(store_id, key)]
+            pinned[store_id].append(key)
+        else:
+            evict_block(store, key)
+
+
+def pin_caches(item):
+    """keeps the entries of the blocks and masks of the item, while they may be iterated, the budget of them may be
+    exceeded until unpin_caches is called"""
+    for key in ["blocks", "masks"]:
+        if key in item and item[key].get("lru") is not None:
+            item[key]["lru"]["pinned"].setdefault(id(item[key]), [])
+
+
+def unpin_caches(item):
+    """allows the eviction of the entries of the blocks and masks of the item again"""
+    for key in ["blocks", "masks"]:
+        if key in item and item[key].get("lru") is not None:
+            budget = item[key]["lru"]
+            # the entries put aside are the least recently used ones
+            kept = [((id(item[key]), entry_key), item[key]) for entry_key in budget["pinned"].pop(id(item[key]), [])]
+            budget["entries"] = dict(kept + list(budget["entries"].items()))
+            evict_cache_entries(budget)
+
+
+def add_cached_block(store, image, params_list):
+    """adds the block to the store and charges it to the budget of the store, if there is one, returns the hash of the
+    block"""
+    array_hash = get_array_hash(image)
+    is_new = array_hash not in store["arrays"]
+    add_block(store, image, params_list, array_hash=array_hash)
+    if is_new:
+        charge_cache_entry(store, array_hash, store["arrays"][array_hash]["array"].nbytes)
+    else:
+        touch_block(store, array_hash)
+    return array_hash
+
+
+def add_cached_failure(store, params_hash):
+    """memoizes the failure of the params in the store and charges it to the budget of the store"""
+    store["params"][params_hash] = None
+    charge_cache_entry(store, params_hash, FAILURE_BYTES)
+
+
+def touch_block(store, key):
+    """marks the block or the failure with the given hash as the most recently used one"""
+    budget = store.get("lru")
+    if budget is not None:
+        key = (id(store), key)
+        if key in budget["entries"]:
+            budget["entries"][key] = budget["entries"].pop(key)
+
+
+def evict_block(store, key):
+    """removes the block or the failure added after the preprocessing from the store together with its params"""
+    budget = store["lru"]
+    del budget["entries"][(id(store), key)]
+    if key in store["arrays"]:
+        data = store["arrays"].pop(key)
+        for params in data["params"]:
+            store["params"].pop(params.hash, None)
+        budget["bytes"] -= data["array"].nbytes
+        remove_trie_nodes(store, key)
+    else:
+        store["params"].pop(key, None)
+        budget["bytes"] -= FAILURE_BYTES
+    budget["evicted"] += 1
+
+
+def add_trie_node(store, node, step, array_hash):
+    """returns the child of the trie node for the step, the nodes are indexed by their arrays"""
+    child = node["children"].get(step)
+    if child is None:
+        child = node["children"][step] = {"array_hash": array_hash, "children": {}}
+        store.setdefault("trie_nodes", {}).setdefault(array_hash, []).append((node, step))
+    return child
+
+
+def remove_trie_nodes(store, array_hash):
+    """removes the trie nodes of the evicted array together with their children"""
+    nodes = store.get("trie_nodes", {})
+    removed = [parent["children"].pop(step) for parent, step in nodes.pop(array_hash, [])]
+    while removed:
+        node = removed.pop()
+        for step, child in node["children"].items():
+            parents = nodes.get(child["array_hash"], [])
+            parents[:] = [(parent, x) for parent, x in parents if parent is not node]
+            if not parents:
+                nodes.pop(child["array_hash"], None)
+            removed.append(child)
+
+
+def index_block_store(store):
+    """rebuilds the params index of the store from its params lists, as the params hashes are not the same in
+    different interpreters"""
+    store["params"] = {}
+    for array_hash, data in store["arrays"].items():
+        for params in data["params"]:
+            store["params"][params.hash] = array_hash
+    return store
+
+
 def get_original(image):
     return 0, image
 
@@ -591,32 +897,362 @@ def get_inversed_colors(image):
     return 0, result
 
 
-def generate_blocks(image, result, max_time=600, max_blocks=200000, max_masks=200000, target_image=None, params=None):
-    all_params = [
-        "initial",
-        "background",
-        "min_max_blocks",
-        "block_with_side_colors",
-        "max_area_covered",
-        "grid_cells",
-        "halves",
-        "corners",
-        "rotate",
-        "transpose",
-        "cut_edges",
-        "resize",
-        "reflect",
-        "cut_parts",
-        "swap_colors",
-        "k_part",
+def get_transform_shape(shape, transform):
+    """returns the shape of the result of the transform applied to the image of the shape without computing it,
+    None if the transform fails or gives an empty block"""
+    x, y = shape
+    if transform["type"] in ["rotation", "transpose"]:
+        if transform["type"] == "transpose" or transform["k"] % 2 == 1:
+            x, y = y, x
+    elif transform["type"] == "cut_edge":
+        x, y = x - transform["t"] - transform["b"], y - transform["l"] - transform["r"]
+    elif transform["type"] == "cut":
+        x, y = transform["x2"] - transform["x1"], transform["y2"] - transform["y1"]
+    elif transform["type"] == "resize":
+        scale = transform["scale"]
+        if isinstance(scale, int):
+            if x % scale != 0 or y % scale != 0:
+                return None
+            x, y = x // scale, y // scale
+        else:
+            x, y = int(x / scale), int(y / scale)
+    elif transform["type"] == "resize_to":
+        scale_x, scale_y = x // transform["size_x"], y // transform["size_y"]
+        if scale_x == 0 or scale_y == 0 or x % scale_x != 0 or y % scale_y != 0:
+            return None
+        x, y = x // scale_x, y // scale_y
+    elif transform["type"] == "reflect":
+        if transform["side"] not in ["t", "b"]:
+            y = 2 * y - 1
+        if transform["side"] not in ["r", "l"]:
+            x = 2 * x - 1
+    elif transform["type"] != "color_swap":
+        return None
+    if x <= 0 or y <= 0:
+        return None
+    return x, y
+
+
+# the transforms applied to each block by the derived stages
+DERIVED_TRANSFORMS = {
+    "rotate": [{"type": "rotation", "k": k} for k in range(1, 4)],
+    "transpose": [{"type": "transpose"}],
+    "cut_edges": [
+        {"type": "cut_edge", "l": l, "r": r, "t": t, "b": b}
+        for l, r, t, b in [
+            (1, 1, 1, 1),
+            (1, 0, 0, 0),
+            (0, 1, 0, 0),
+            (0, 0, 1, 0),
+            (0, 0, 0, 1),
+            (1, 1, 0, 0),
+            (1, 0, 0, 1),
+            (0, 0, 1, 1),
+            (0, 1, 1, 0),
+        ]
+    ],
+    "resize": [{"type": "resize", "scale": scale} for scale in [2, 3, 1 / 2, 1 / 3]]
+    + [{"type": "resize_to", "size_x": size, "size_y": size} for size in [2, 3]],
+    "reflect": [{"type": "reflect", "side": side} for side in ["r", "l", "t", "b", "rt", "rb", "lt", "lb"]],
+    "cut_parts": [],
+    "swap_colors": [],
+}
+
+
+def get_shape_filter(target_shapes, params):
+    """returns the function checking if the block of the shape made by the derived stage can get one of
+    target_shapes through the next stages"""
+    stages = [stage for stage in DERIVED_TRANSFORMS if stage in params]
+    target_shapes = {tuple(shape) for shape in target_shapes}
+    memo = {}
+
+    def is_reachable(shape, start):
+        if (shape, start) not in memo:
+            memo[(shape, start)] = shape in target_shapes or any(
+                new_shape is not None and is_reachable(new_shape, stages.index(stage) + 1)
+                for stage in stages[start:]
+                for new_shape in [get_transform_shape(shape, transform) for transform in DERIVED_TRANSFORMS[stage]]
+            )
+        return memo[(shape, start)]
+
+    def is_useful(shape, stage):
+        return is_reachable(tuple(shape), stages.index(stage) + 1)
+
+    return is_useful
+
+
+# number of transforms applied to each block by the stage, the part of them giving blocks and the size of those blocks
+DERIVED_STAGES_WORK = {
+    "rotate": (3, 0.75, 1),
+    "transpose": (1, 0.75, 1),
+    "cut_edges": (9, 0.9, 0.7),
+    "resize": (6, 0.2, 1),
+    "reflect": (8, 0.9, 3),
+    "cut_parts": (0, 0, 0),
+    "swap_colors": (45, 0, 1),
+}
+
+
+def get_store_size(store):
+    """returns the number of arrays, array cells and params in the store"""
+    arrays = store["arrays"].values()
+    return (
+        len(arrays),
+        sum([data["array"].size for data in arrays]),
+        sum([len(data["params"]) for data in arrays]),
+    )
+
+
+def get_stage_work(stage, image, colors_num, size):
+    """estimates the work (array cells processed and params created) of the derived stage and the size of the store
+    after it"""
+    arrays_num, cells_num, params_num = size
+    if stage == "cut_parts":
+        # windows of at least 2x2 cells of the image without the last row and column
+        max_x, max_y = image.shape[0] - 1, image.shape[1] - 1
+        windows_num = sum(range(max_x)) * sum(range(max_y))
+        windows_cells = sum([s * (max_x - s + 1) for s in range(2, max_x + 1)]) * sum(
+            [s * (max_y - s + 1) for s in range(2, max_y + 1)]
+        )
+        size = (arrays_num + windows_num, cells_num + windows_cells, params_num + windows_num)
+        return windows_cells + windows_num, size
+
+    transforms_num, part, scale = DERIVED_STAGES_WORK[stage]
+    if stage == "swap_colors":
+        # the swap gives a block if at least one of the colors is present
+        part = 1 - (10 - colors_num) * (9 - colors_num) / 90
+    new_arrays = transforms_num * part * arrays_num
+    work = transforms_num * (cells_num + part * params_num)
+    return work, (
+        arrays_num + new_arrays,
+        cells_num + new_arrays * scale * cells_num / max(arrays_num, 1),
+        params_num + transforms_num * part * params_num,
+    )
+
+
+def create_work_budget(max_work, image, result, params):
+    """returns the budget of the derived stages and the masks of the image, the derived stages are chosen greedily by
+    the expected new blocks per work and run in the usual order, the masks stages are added by generate_masks"""
+    if max_work is None:
+        return None
+    colors_num = len(result["colors_sorted"])
+    stages = [stage for stage in DERIVED_STAGES_WORK if stage in params]
+    chosen = []
+
+    def estimate(chosen_stages):
+        work, size = 0, get_store_size(result["blocks"])
+        for stage in stages:
+            if stage in chosen_stages:
+                stage_work, size = get_stage_work(stage, image, colors_num, size)
+                work += stage_work
+        return work, size[0]
+
+    work, arrays_num = estimate(chosen)
+    while True:
+        best = None
+        for stage in stages:
+            if stage in chosen:
+                continue
+            new_work, new_arrays_num = estimate(chosen + [stage])
+            if new_work > max_work:
+                continue
+            efficiency = (new_arrays_num - arrays_num) / max(new_work - work, 1)
+            if best is None or efficiency > best[0]:
+                best = (efficiency, stage, new_work, new_arrays_num)
+        if best is None:
+            break
+        _, stage, work, arrays_num = best
+        chosen.append(stage)
+
+    return {"max_work": max_work, "work": 0, "stages": chosen, "colors_num": colors_num}
+
+
+def get_combined_masks_work(buckets):
+    """estimates the work of add_combined_masks for the numbers of masks and their params {shape: [masks, params]}"""
+    return sum([3 * (n * (n - 1) // 2 * (x * y // 8 + 1) + p * p // 2) for (x, y), (n, p) in buckets.items()])
+
+
+def get_masks_work(stage, image, store, colors_num):
+    """estimates the work (array cells processed and params created) of the masks stage"""
+    if stage == "coverage_masks":
+        # the search of the color, its boundaries and the comparison with it for each color except the background
+        return 3 * max(colors_num - 1, 0) * (image.size + 1)
+    if stage == "min_max_masks":
+        # the labels of the components and the comparison with the smallest and the largest of them
+        return 2 * 2 * (image.size + 1)
+    if stage == "additional_masks":
+        # every pair of masks of the same shape is combined in three ways
+        buckets = {}
+        for data in store["arrays"].values():
+            bucket = buckets.setdefault(data["array"].shape, [0, 0])
+            bucket[0] += 1
+            bucket[1] += len(data["params"])
+        return get_combined_masks_work(buckets)
+    # a mask and its negation for each block and color
+    _, cells_num, params_num = get_store_size(store)
+    return 2 * colors_num * (cells_num + params_num)
+
+
+def get_masks_yield(stage, image, blocks, colors_num):
+    """estimates the work and the number of new masks of the masks stage made from the blocks, the combined masks are
+    estimated from the initial masks"""
+    if stage == "additional_masks":
+        buckets = {}
+        for data in blocks["arrays"].values():
+            bucket = buckets.setdefault(data["array"].shape, [0, 0])
+            bucket[0] += 2 * colors_num
+            bucket[1] += 2 * colors_num * len(data["params"])
+        new_masks = sum([3 * n * (n - 1) // 2 for n, _ in buckets.values()])
+        return get_combined_masks_work(buckets), new_masks
+    new_masks = {
+        "initial_masks": 2 * colors_num * len(blocks["arrays"]),
+        "coverage_masks": max(colors_num - 1, 0),
+        "min_max_masks": 2,
+    }[stage]
+    return get_masks_work(stage, image, blocks, colors_num), new_masks
+
+
+def add_masks_stages(budget, image, result, params):
+    """adds the masks stages of params to the stages of the budget, the stages with the most expected new masks per
+    work are chosen first while their work fits into the rest of the budget"""
+    estimates = [
+        (stage,) + get_masks_yield(stage, image, result["blocks"], budget["colors_num"])
+        for stage in DEFAULT_MASKS_PARAMS
+        if stage in params
     ]
+    estimates.sort(key=lambda x: -x[2] / max(x[1], 1))
+    work = budget["work"]
+    for stage, stage_work, _ in estimates:
+        if work + stage_work <= budget["max_work"]:
+            budget["stages"].append(stage)
+            work += stage_work
+    return budget
+
+
+def spend_work(budget, stage, image, store):
+    """charges the work of the stage estimated for the current store to the budget, returns False if the stage is not
+    chosen or the work does not fit"""
+    if budget is None:
+        return True
+    if stage not in budget["stages"]:
+        return False
+    if stage in DERIVED_STAGES_WORK:
+        work, _ = get_stage_work(stage, image, budget["colors_num"], get_store_size(store))
+    else:
+        work = get_masks_work(stage, image, store, budget["colors_num"])
+    if budget["work"] + work > budget["max_work"]:
+        return False
+    budget["work"] += work
+    return True
+
+
+DEFAULT_BLOCKS_PARAMS = [
+    "initial",
+    "background",
+    "min_max_blocks",
+    "block_with_side_colors",
+    "max_area_covered",
+    "grid_cells",
+    "halves",
+    "corners",
+    "rotate",
+    "transpose",
+    "cut_edges",
+    "resize",
+    "reflect",
+    "cut_parts",
+    "swap_colors",
+    "k_part",
+]
+DEFAULT_MASKS_PARAMS = ["initial_masks", "additional_masks", "coverage_masks", "min_max_masks"]
+
+
+def generate_blocks(
+    image,
+    result,
+    max_time=600,
+    max_blocks=200000,
+    max_masks=200000,
+    target_image=None,
+    params=None,
+    max_work=None,
+    prune_by_target=False,
+):
+    if not params:
+        params = DEFAULT_BLOCKS_PARAMS
+
+    # only the derived blocks that can have the shape of the target are useful for the predictors comparing them
+    target_shapes = None
+    if prune_by_target and target_image is not None:
+        target_shapes = [target_image.shape]
+
+    # the work budget replaces the time limit, so the blocks don't depend on the machine load
+    max_time = get_time_limit(max_time, max_work)
+    start_time = time.time()
+    generate_seed_blocks(image, result, start_time, max_time, max_blocks, params)
+
+    main_blocks_num = len(result["blocks"])
+
+    generate_derived_blocks(image, result, start_time, max_time, max_blocks, params, max_work, target_shapes)
+    mark_time_limit(result, start_time, max_time)
+
+    return result
+
+
+def extend_blocks(image, result, params, seed=False, max_time=600, max_blocks=200000):
+    """adds the blocks of the stages of params to the result, which has the blocks of the stages before them, the seed
+    stages are run only if seed is True, so the blocks made by generate_blocks are made in several calls"""
+    start_time = time.time()
+    if seed:
+        generate_seed_blocks(image, result, start_time, max_time, max_blocks, params)
+    generate_derived_blocks(image, result, start_time, max_time, max_blocks, params)
+    mark_time_limit(result, start_time, max_time)
+    return result
 
+
+def iterate_blocks(
+    image,
+    result,
+    max_time=600,
+    max_blocks=200000,
+    target_image=None,
+    params=None,
+    max_work=None,
+    prune_by_target=False,
+):
+    """works like generate_blocks, but yields "seed" after the blocks made from the original image and then the name
+    of each derived stage of params after its blocks are added"""
     if not params:
-        params = all_params
+        params = DEFAULT_BLOCKS_PARAMS
 
+    target_shapes = None
+    if prune_by_target and target_image is not None:
+        target_shapes = [target_image.shape]
+
+    # the work budget replaces the time limit, so the blocks don't depend on the machine load
+    max_time = get_time_limit(max_time, max_work)
     start_time = time.time()
+    generate_seed_blocks(image, result, start_time, max_time, max_blocks, params)
+    yield "seed"
+    yield from iterate_derived_blocks(image, result, start_time, max_time, max_blocks, params, max_work, target_shapes)
+    mark_time_limit(result, start_time, max_time)
+
 
-    result["blocks"] = {"arrays": {}, "params": {}}
+def get_time_limit(max_time, max_work):
+    """returns the time limit of the generation, which has no time limit if it has the work budget"""
+    return float("inf") if max_work is not None else max_time
+
+
+def mark_time_limit(result, start_time, max_time):
+    """marks the result, whose stages may have been skipped by the time limit, as the one cut short, all the checks
+    of the time limit have passed if it is not reached yet"""
+    if time.time() - start_time >= max_time:
+        result["cut_short"] = True
+
+
+def generate_seed_blocks(image, result, start_time, max_time=600, max_blocks=200000, params=None):
+    """adds the blocks made from the original image"""
+    result["blocks"] = create_block_store()
 
     if "initial" in params:
         # starting with the original image
@@ -635,7 +1271,7 @@ def generate_blocks(image, result, max_time=600, max_blocks=200000, max_masks=20
     ):
         # print("min_max_blocks")
         for full in [True, False]:
-            status, block = get_max_block(image, full)
+            status, block = get_max_block(image, full, result["blocks"])
             if status == 0 and block.shape[0] > 0 and block.shape[1] > 0:
                 add_block(result["blocks"], block, [[{"type": "max_block", "full": full}]])
 
@@ -647,7 +1283,7 @@ def generate_blocks(image, result, max_time=600, max_blocks=200000, max_masks=20
         # print("min_max_blocks")
         for block_type in ["min", "max"]:
             for structure in [0, 1]:
-                status, block = get_block_with_side_colors(image, block_type, structure)
+                status, block = get_block_with_side_colors(image, block_type, structure, result["blocks"])
                 if status == 0 and block.shape[0] > 0 and block.shape[1] > 0:
                     add_block(
                         result["blocks"],
@@ -656,7 +1292,7 @@ def generate_blocks(image, result, max_time=600, max_blocks=200000, max_masks=20
                     )
         for block_type in ["min", "max"]:
             for structure in [0, 1]:
-                status, block = get_block_with_side_colors_count(image, block_type, structure)
+                status, block = get_block_with_side_colors_count(image, block_type, structure, result["blocks"])
                 if status == 0 and block.shape[0] > 0 and block.shape[1] > 0:
                     add_block(
                         result["blocks"],
@@ -757,115 +1393,161 @@ def generate_blocks(image, result, max_time=600, max_blocks=200000, max_masks=20
             if status == 0 and block.shape[0] > 0 and block.shape[1] > 0:
                 add_block(result["blocks"], block, [[{"type": "corner", "side": side}]])
 
-    main_blocks_num = len(result["blocks"])
+
+def generate_derived_blocks(
+    image, result, start_time, max_time=600, max_blocks=200000, params=None, max_work=None, target_shapes=None
+):
+    """transforms the blocks generated from the original image, if target_shapes are given, only the blocks that can
+    get one of them are computed"""
+    for _ in iterate_derived_blocks(image, result, start_time, max_time, max_blocks, params, max_work, target_shapes):
+        pass
+    return result
+
+
+def iterate_derived_blocks(
+    image, result, start_time, max_time=600, max_blocks=200000, params=None, max_work=None, target_shapes=None
+):
+    """works like generate_derived_blocks, but yields the name of each stage of params after its blocks are added"""
+    # the stages are chosen before any of them is run, so the result does not depend on the machine load,
+    # the budget is kept in the result to pay for the masks too
+    budget = create_work_budget(max_work, image, result, params)
+    if budget is not None:
+        result["work_budget"] = budget
+    is_useful = None if target_shapes is None else get_shape_filter(target_shapes, params)
+
+    # rotations and transposes of the same block are taken from its dihedral images
+    orbits = {}
 
     # rotate all blocks
-    if ("rotate" in params) and (time.time() - start_time < max_time) and (len(result["blocks"]["arrays"]) < max_blocks):
+    if (
+        ("rotate" in params)
+        and (time.time() - start_time < max_time)
+        and (len(result["blocks"]["arrays"]) < max_blocks)
+        and spend_work(budget, "rotate", image, result["blocks"])
+    ):
         current_blocks = result["blocks"]["arrays"].copy()
         for k in range(1, 4):
+            step = intern_params({"type": "rotation", "k": k})
             for key, data in current_blocks.items():
-                status, block = get_rotation(data["array"], k=k)
-                if status == 0 and block.shape[0] > 0 and block.shape[1] > 0:
-                    params_list = [i + [{"type": "rotation", "k": k}] for i in data["params"]]
-                    add_block(result["blocks"], block, params_list)
+                if is_useful and not is_useful(get_transform_shape(data["array"].shape, step), "rotate"):
+                    continue
+                block_hash, block = get_dihedral_image(orbits, key, data["array"], (k, False))
+                if block.shape[0] > 0 and block.shape[1] > 0:
+                    params_list = [append_step(i, step) for i in data["params"]]
+                    add_block(result["blocks"], block, params_list, array_hash=block_hash)
+
+    if "rotate" in params:
+        yield "rotate"
 
     # transpose all blocks
     if (
         ("transpose" in params)
         and (time.time() - start_time < max_time)
         and (len(result["blocks"]["arrays"]) < max_blocks)
+        and spend_work(budget, "transpose", image, result["blocks"])
     ):
         current_blocks = result["blocks"]["arrays"].copy()
+        step = intern_params({"type": "transpose"})
         for key, data in current_blocks.items():
-            status, block = get_transpose(data["array"])
-            if status == 0 and block.shape[0] > 0 and block.shape[1] > 0:
-                params_list = [i + [{"type": "transpose"}] for i in data["params"]]
-                add_block(result["blocks"], block, params_list)
+            if is_useful and not is_useful(data["array"].shape[::-1], "transpose"):
+                continue
+            block_hash, block = get_dihedral_image(orbits, key, data["array"], (0, True))
+            if block.shape[0] > 0 and block.shape[1] > 0:
+                params_list = [append_step(i, step) for i in data["params"]]
+                add_block(result["blocks"], block, params_list, array_hash=block_hash)
+
+    if "transpose" in params:
+        yield "transpose"
 
     # cut edges for all blocks
     if (
         ("cut_edges" in params)
         and (time.time() - start_time < max_time)
         and (len(result["blocks"]["arrays"]) < max_blocks)
+        and spend_work(budget, "cut_edges", image, result["blocks"])
     ):
         current_blocks = result["blocks"]["arrays"].copy()
-        for l, r, t, b in [
-            (1, 1, 1, 1),
-            (1, 0, 0, 0),
-            (0, 1, 0, 0),
-            (0, 0, 1, 0),
-            (0, 0, 0, 1),
-            (1, 1, 0, 0),
-            (1, 0, 0, 1),
-            (0, 0, 1, 1),
-            (0, 1, 1, 0),
-        ]:
+        for step in DERIVED_TRANSFORMS["cut_edges"]:
             if time.time() - start_time < max_time:
+                step = intern_params(step)
                 for key, data in current_blocks.items():
-                    status, block = get_cut_edge(data["array"], l=l, r=r, t=t, b=b)
+                    shape = get_transform_shape(data["array"].shape, step)
+                    if is_useful and (shape is None or not is_useful(shape, "cut_edges")):
+                        continue
+                    status, block = get_cut_edge(data["array"], l=step["l"], r=step["r"], t=step["t"], b=step["b"])
                     if status == 0 and block.shape[0] > 0 and block.shape[1] > 0:
-                        params_list = [
-                            i + [{"type": "cut_edge", "l": l, "r": r, "t": t, "b": b}] for i in data["params"]
-                        ]
+                        params_list = [append_step(i, step) for i in data["params"]]
                         add_block(result["blocks"], block, params_list)
 
+    if "cut_edges" in params:
+        yield "cut_edges"
+
     # resize all blocks
-    if ("resize" in params) and (time.time() - start_time < max_time) and (len(result["blocks"]["arrays"]) < max_blocks):
+    if (
+        ("resize" in params)
+        and (time.time() - start_time < max_time)
+        and (len(result["blocks"]["arrays"]) < max_blocks)
+        and spend_work(budget, "resize", image, result["blocks"])
+    ):
         current_blocks = result["blocks"]["arrays"].copy()
         for scale in [2, 3, 1 / 2, 1 / 3]:
+            step = intern_params({"type": "resize", "scale": scale})
             for key, data in current_blocks.items():
+                shape = get_transform_shape(data["array"].shape, step)
+                if is_useful and (shape is None or not is_useful(shape, "resize")):
+                    continue
                 status, block = get_resize(data["array"], scale)
                 if status == 0 and block.shape[0] > 0 and block.shape[1] > 0:
-                    params_list = [i + [{"type": "resize", "scale": scale}] for i in data["params"]]
+                    params_list = [append_step(i, step) for i in data["params"]]
                     add_block(result["blocks"], block, params_list)
 
         for size_x, size_y in [(2, 2), (3, 3)]:
+            step = intern_params({"type": "resize_to", "size_x": size_x, "size_y": size_y})
             for key, data in current_blocks.items():
+                shape = get_transform_shape(data["array"].shape, step)
+                if is_useful and (shape is None or not is_useful(shape, "resize")):
+                    continue
                 status, block = get_resize_to(data["array"], size_x, size_y)
                 if status == 0 and block.shape[0] > 0 and block.shape[1] > 0:
-                    params_list = [
-                        i + [{"type": "resize_to", "size_x": size_x, "size_y": size_y}] for i in data["params"]
-                    ]
+                    params_list = [append_step(i, step) for i in data["params"]]
                     add_block(result["blocks"], block, params_list)
 
+    if "resize" in params:
+        yield "resize"
+
     # reflect all blocks
     if (
         ("reflect" in params)
         and (time.time() - start_time < max_time)
         and (len(result["blocks"]["arrays"]) < max_blocks)
+        and spend_work(budget, "reflect", image, result["blocks"])
     ):
         current_blocks = result["blocks"]["arrays"].copy()
-        for side in ["r", "l", "t", "b", "rt", "rb", "lt", "lb"]:
+        for step in DERIVED_TRANSFORMS["reflect"]:
             if time.time() - start_time < max_time:
+                step = intern_params(step)
                 for key, data in current_blocks.items():
-                    status, block = get_reflect(data["array"], side)
+                    if is_useful and not is_useful(get_transform_shape(data["array"].shape, step), "reflect"):
+                        continue
+                    status, block = get_reflect(data["array"], step["side"])
                     if status == 0 and block.shape[0] > 0 and block.shape[1] > 0:
-                        params_list = [i + [{"type": "reflect", "side": side}] for i in data["params"]]
+                        params_list = [append_step(i, step) for i in data["params"]]
                         add_block(result["blocks"], block, params_list)
 
+    if "reflect" in params:
+        yield "reflect"
+
     # cut some parts of images
     if (
         ("cut_parts" in params)
         and (time.time() - start_time < max_time)
         and (len(result["blocks"]["arrays"]) < max_blocks)
+        and spend_work(budget, "cut_parts", image, result["blocks"])
     ):
-        max_x = image.shape[0]
-        max_y = image.shape[1]
-        min_block_size = 2
-        for x1 in range(0, max_x - min_block_size):
-            if time.time() - start_time < max_time:
-                if max_x - x1 <= min_block_size:
-                    continue
-                for x2 in range(x1 + min_block_size, max_x):
-                    for y1 in range(0, max_y - min_block_size):
-                        if max_y - y1 <= min_block_size:
-                            continue
-                        for y2 in range(y1 + min_block_size, max_y):
-                            status, block = get_cut(image, x1, y1, x2, y2)
-                            if status == 0:
-                                add_block(
-                                    result["blocks"], block, [[{"type": "cut", "x1": x1, "x2": x2, "y1": y1, "y2": y2}]]
-                                )
+        add_cut_parts(image, result, start_time, max_time, is_useful=is_useful)
+
+    if "cut_parts" in params:
+        yield "cut_parts"
 
     list_param_list = []
     list_blocks = []
@@ -875,23 +1557,23 @@ def generate_blocks(image, result, max_time=600, max_blocks=200000, max_masks=20
         ("swap_colors" in params)
         and (time.time() - start_time < max_time)
         and (len(result["blocks"]["arrays"]) < max_blocks)
+        and spend_work(budget, "swap_colors", image, result["blocks"])
     ):
         current_blocks = result["blocks"]["arrays"].copy()
         for color_1 in range(9):
             if time.time() - start_time < max_time:
                 for color_2 in range(color_1 + 1, 10):
                     for key, data in current_blocks.items():
+                        if is_useful and not is_useful(data["array"].shape, "swap_colors"):
+                            continue
                         status, block = get_color_swap(data["array"], color_1, color_2)
                         if status == 0 and block.shape[0] > 0 and block.shape[1] > 0:
                             for color_dict_1 in result["colors"][color_1].copy():
                                 for color_dict_2 in result["colors"][color_2].copy():
-                                    list_param_list.append(
-                                        [
-                                            j
-                                            + [{"type": "color_swap", "color_1": color_dict_1, "color_2": color_dict_2}]
-                                            for j in data["params"]
-                                        ]
+                                    step = intern_params(
+                                        {"type": "color_swap", "color_1": color_dict_1, "color_2": color_dict_2}
                                     )
+                                    list_param_list.append([append_step(j, step) for j in data["params"]])
                                     list_blocks.append(block)
 
     for block, params_list in zip(list_blocks, list_param_list):
@@ -901,22 +1583,125 @@ def generate_blocks(image, result, max_time=600, max_blocks=200000, max_masks=20
         print("Time is over")
     if len(result["blocks"]["arrays"]) >= max_blocks:
         print("Max number of blocks exceeded")
-    return result
-
-
-def generate_masks(image, result, max_time=600, max_blocks=200000, max_masks=200000, target_image=None, params=None):
+    if "swap_colors" in params:
+        yield "swap_colors"
+
+
+def add_cut_parts(image, result, start_time, max_time=600, min_block_size=2, is_useful=None):
+    """adds all the cuts of the image, the windows of each size are deduped and hashed together and each unique
+    block is registered once with all its cuts, the sizes rejected by is_useful are skipped"""
+    # the cuts never include the last row and column of the image
+    image = np.ascontiguousarray(image[:-1, :-1])
+    max_x, max_y = image.shape
+
+    blocks, hashes, columns = [], [], []
+    for size_x in range(min_block_size, max_x + 1):
+        for size_y in range(min_block_size, max_y + 1):
+            if time.time() - start_time >= max_time:
+                break
+            if is_useful and not is_useful((size_x, size_y), "cut_parts"):
+                continue
+            num_x, num_y = max_x - size_x + 1, max_y - size_y + 1
+            size = size_x * size_y
+            view = as_strided(image, shape=(num_x, num_y, size_x, size_y), strides=image.strides * 2)
+            # each window is compared as one opaque value of size_x * size_y bytes
+            rows = np.ascontiguousarray(view).reshape(num_x * num_y, size).view(np.dtype((np.void, size)))
+            unique, inverse = np.unique(rows.ravel(), return_inverse=True)
+            data = unique.tobytes()
+            x1, y1 = np.divmod(np.arange(num_x * num_y), num_y)
+            columns.append(np.stack([x1, x1 + size_x, y1, y1 + size_y, inverse.ravel() + len(blocks)], 1))
+            hashes.extend(
+                [get_bytes_hash((size_x, size_y), data[i * size : (i + 1) * size]) for i in range(len(unique))]
+            )
+            blocks.extend(unique.view(np.uint8).reshape(-1, size_x, size_y))
+    if not blocks:
+        return
+
+    # the cuts are ordered by their coordinates and grouped by their blocks, the blocks are ordered by their first cuts
+    cuts = np.concatenate(columns)
+    cuts = cuts[np.lexsort(cuts[:, 3::-1].T)]
+    order = np.argsort(cuts[:, 4], kind="stable")
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(cuts[:, 4], minlength=len(blocks)))])
+    first_cuts = np.unique(cuts[:, 4], return_index=True)[1]
+    coordinates = cuts[order, :4].tolist()
+
+    store = result["blocks"]
+    for i in np.argsort(first_cuts).tolist():
+        # every cut has its own coordinates, so there is nothing to share with
+        params_list = [
+            create_params([create_params({"type": "cut", "x1": x1, "x2": x2, "y1": y1, "y2": y2})])
+            for x1, x2, y1, y2 in coordinates[bounds[i] : bounds[i + 1]]
+        ]
+        params_list = [params for params in params_list if params.hash not in store["params"]]
+        if hashes[i] not in store["arrays"]:
+            store["arrays"][hashes[i]] = {"array": blocks[i], "params": []}
+        store["arrays"][hashes[i]]["params"].extend(params_list)
+        store["params"].update([(params.hash, hashes[i]) for params in params_list])
+
+
+def add_combined_masks(result, start_time, max_time=600, target_image=None):
+    """adds and/or/xor of all the pairs of masks of the same shape, equal results are added once"""
+    buckets = {}
+    for key, mask in result["masks"]["arrays"].items():
+        # the params lists are copied as the combined masks may be equal to the initial ones
+        buckets.setdefault(mask["array"].shape, []).append((mask["array"], mask["params"].copy()))
+
+    combined = {}
+    for shape, masks in buckets.items():
+        if target_image is not None and target_image.shape != shape and target_image.shape != shape[::-1]:
+            continue
+        # the masks are compared and combined as packed bit rows
+        bits = np.packbits(np.stack([array for array, _ in masks]).reshape(len(masks), -1), axis=1)
+        for i in range(len(masks) - 1):
+            if time.time() - start_time >= max_time * 2:
+                break
+            rows = np.stack([bits[i] & bits[i + 1 :], bits[i] | bits[i + 1 :], bits[i] ^ bits[i + 1 :]], axis=1)
+            for n, row in enumerate(rows.reshape(-1, bits.shape[1])):
+                sources = combined.setdefault((shape, row.tobytes()), [])
+                sources.append((("and", "or", "xor")[n % 3], masks[i], masks[i + 1 + n // 3]))
+
+    for (shape, data), sources in combined.items():
+        array = np.unpackbits(np.frombuffer(data, dtype=np.uint8))[: shape[0] * shape[1]].reshape(shape)
+        params_list = [
+            {"operation": operation, "params": {"mask1": param1, "mask2": param2}}
+            for operation, (_, params_list_1), (_, params_list_2) in sources
+            for param1 in params_list_1
+            for param2 in params_list_2
+        ]
+        add_block(result["masks"], array.astype(bool), params_list)
+
+
+def generate_masks(
+    image,
+    result,
+    max_time=600,
+    max_blocks=200000,
+    max_masks=200000,
+    target_image=None,
+    params=None,
+    max_work=None,
+):
     start_time = time.time()
-
-    all_params = ["initial_masks", "additional_masks", "coverage_masks", "min_max_masks"]
+    max_time = get_time_limit(max_time, max_work)
 
     if not params:
-        params = all_params
+        params = DEFAULT_MASKS_PARAMS
 
-    result["masks"] = {"arrays": {}, "params": {}}
+    result["masks"] = create_block_store()
+    # the masks are paid from the same budget as the blocks, the stages are chosen in the order of their expected
+    # new masks per work, but run in the usual order, as the combined masks depend on the initial ones
+    budget = None
+    if max_work is not None:
+        budget = result.get("work_budget") or create_work_budget(max_work, image, result, [])
+        add_masks_stages(budget, image, result, params)
 
     # making one mask for each generated block
     current_blocks = result["blocks"]["arrays"].copy()
-    if ("initial_masks" in params) and (time.time() - start_time < max_time * 2):
+    if (
+        ("initial_masks" in params)
+        and (time.time() - start_time < max_time * 2)
+        and spend_work(budget, "initial_masks", image, result["blocks"])
+    ):
         for key, data in current_blocks.items():
             for color in result["colors_sorted"]:
                 status, mask = get_mask_from_block(data["array"], color)
@@ -937,49 +1722,19 @@ def generate_masks(image, result, max_time=600, max_blocks=200000, max_masks=200
                 [{"operation": "not", "params": param["params"]} for param in mask["params"]],
             )
 
-    initial_masks = result["masks"]["arrays"].copy()
-    masks_to_add = []
-    processed = []
-    if ("additional_masks" in params) and (time.time() - start_time < max_time * 2):
-        for key1, mask1 in initial_masks.items():
-            processed.append(key1)
-            if time.time() - start_time < max_time * 2 and (
-                target_image is None
-                or (target_image.shape == mask1["array"].shape)
-                or (target_image.shape == mask1["array"].T.shape)
-            ):
-                for key2, mask2 in initial_masks.items():
-                    if key2 in processed:
-                        continue
-                    if (mask1["array"].shape[0] == mask2["array"].shape[0]) and (
-                        mask1["array"].shape[1] == mask2["array"].shape[1]
-                    ):
-                        params_list_and = []
-                        params_list_or = []
-                        params_list_xor = []
-                        for param1 in mask1["params"]:
-                            for param2 in mask2["params"]:
-                                params_list_and.append(
-                                    {"operation": "and", "params": {"mask1": param1, "mask2": param2}}
-                                )
-                                params_list_or.append({"operation": "or", "params": {"mask1": param1, "mask2": param2}})
-                                params_list_xor.append(
-                                    {"operation": "xor", "params": {"mask1": param1, "mask2": param2}}
-                                )
-                        masks_to_add.append(
-                            (result["masks"], np.logical_and(mask1["array"], mask2["array"]), params_list_and)
-                        )
-                        masks_to_add.append(
-                            (result["masks"], np.logical_or(mask1["array"], mask2["array"]), params_list_or)
-                        )
-                        masks_to_add.append(
-                            (result["masks"], np.logical_xor(mask1["array"], mask2["array"]), params_list_xor)
-                        )
+    if (
+        ("additional_masks" in params)
+        and (time.time() - start_time < max_time * 2)
+        and spend_work(budget, "additional_masks", image, result["masks"])
+    ):
+        add_combined_masks(result, start_time, max_time, target_image)
 
-    for path, array, params_list in masks_to_add:
-        add_block(path, array, params_list)
     # coverage_masks
-    if ("coverage_masks" in params) and (time.time() - start_time < max_time * 2):
+    if (
+        ("coverage_masks" in params)
+        and (time.time() - start_time < max_time * 2)
+        and spend_work(budget, "coverage_masks", image, result["masks"])
+    ):
         for color in result["colors_sorted"][1:]:
             status, mask = get_mask_from_max_color_coverage(image, color)
             if status == 0 and mask.shape[0] > 0 and mask.shape[1] > 0:
@@ -988,18 +1743,23 @@ def generate_masks(image, result, max_time=600, max_blocks=200000, max_masks=200
                     for color_dict in result["colors"][color].copy()
                 ]
                 add_block(result["masks"], mask, params_list)
-    # coverage_masks
-    if ("min_max_masks" in params) and (time.time() - start_time < max_time * 2):
-        status, mask = get_min_block_mask(image)
+    # min_max_masks
+    if (
+        ("min_max_masks" in params)
+        and (time.time() - start_time < max_time * 2)
+        and spend_work(budget, "min_max_masks", image, result["masks"])
+    ):
+        status, mask = get_min_block_mask(image, store=result.get("blocks"))
         if status == 0 and mask.shape[0] > 0 and mask.shape[1] > 0:
             params_list = [{"operation": "min_block"}]
             add_block(result["masks"], mask, params_list)
-        status, mask = get_max_block_mask(image)
+        status, mask = get_max_block_mask(image, store=result.get("blocks"))
         if status == 0 and mask.shape[0] > 0 and mask.shape[1] > 0:
             params_list = [{"operation": "max_block"}]
             add_block(result["masks"], mask, params_list)
     if time.time() - start_time > max_time:
         print("Time is over")
+    mark_time_limit(result, start_time, max_time)
     if len(result["blocks"]["arrays"]) >= max_masks:
         print("Max number of masks exceeded")
     return result
@@ -1018,32 +1778,43 @@ def process_image(
 
 
 def get_mask_from_block_params(image, params, block_cache=None, mask_cache=None, color_scheme=None):
+    """returns the mask described by params, the results and the failures are memoized in mask_cache"""
     if mask_cache is None:
-        mask_cache = {{"arrays": {}, "params": {}}}
+        mask_cache = create_block_store()
+    stats = mask_cache.setdefault("stats", {"hits": 0, "misses": 0})
     dict_hash = get_dict_hash(params)
-    if dict_hash in mask_cache:
-        mask = mask_cache["arrays"][mask_cache["params"][dict_hash]]["array"]
-        if len(mask) == 0:
+    if dict_hash in mask_cache["params"]:
+        stats["hits"] += 1
+        if mask_cache["params"][dict_hash] is None:
+            touch_block(mask_cache, dict_hash)
             return 1, None
         else:
-            return 0, mask
+            touch_block(mask_cache, mask_cache["params"][dict_hash])
+            return 0, mask_cache["arrays"][mask_cache["params"][dict_hash]]["array"]
+
+    stats["misses"] += 1
+    status, mask = calculate_mask(image, params, block_cache, mask_cache, color_scheme)
+    if status != 0:
+        add_cached_failure(mask_cache, dict_hash)
+        return status, None
+    add_cached_block(mask_cache, mask, [params])
+    return 0, mask
 
+
+def calculate_mask(image, params, block_cache, mask_cache, color_scheme):
+    """calculates the mask described by params, the nested masks are taken from mask_cache"""
     if params["operation"] == "none":
         status, block = get_predict(image, params["params"]["block"], block_cache, color_scheme)
         if status != 0:
-            add_block(mask_cache, np.array([[]]), [params])
             return 1, None
         if not color_scheme:
             color_scheme = get_color_scheme(image)
-        color_num = get_color(params["params"]["color"], color_scheme["colors"])
+        color_num = get_color(params["params"]["color"], color_scheme["colors"], color_scheme["colors_index"])
         if color_num < 0:
-            add_block(mask_cache, np.array([[]]), [params])
             return 2, None
         status, mask = get_mask_from_block(block, color_num)
         if status != 0:
-            add_block(mask_cache, np.array([[]]), [params])
             return 6, None
-        add_block(mask_cache, mask, [params])
         return 0, mask
     elif params["operation"] == "not":
         new_params = params.copy()
@@ -1052,10 +1823,8 @@ def get_mask_from_block_params(image, params, block_cache=None, mask_cache=None,
             image, new_params, block_cache=block_cache, color_scheme=color_scheme, mask_cache=mask_cache
         )
         if status != 0:
-            add_block(mask_cache, np.array([[]]), [params])
             return 3, None
         mask = np.logical_not(mask)
-        add_block(mask_cache, mask, [params])
         return 0, mask
     elif params["operation"] in ["and", "or", "xor"]:
         new_params = params["params"]["mask1"]
@@ -1063,17 +1832,14 @@ def get_mask_from_block_params(image, params, block_cache=None, mask_cache=None,
             image, new_params, block_cache=block_cache, color_scheme=color_scheme, mask_cache=mask_cache
         )
         if status != 0:
-            add_block(mask_cache, np.array([[]]), [params])
             return 4, None
         new_params = params["params"]["mask2"]
         status, mask2 = get_mask_from_block_params(
             image, new_params, block_cache=block_cache, color_scheme=color_scheme, mask_cache=mask_cache
         )
         if status != 0:
-            add_block(mask_cache, np.array([[]]), [params])
             return 5, None
         if mask1.shape[0] != mask2.shape[0] or mask1.shape[1] != mask2.shape[1]:
-            add_block(mask_cache, np.array([[]]), [params])
             return 6, None
         if params["operation"] == "and":
             mask = np.logical_and(mask1, mask2)
@@ -1081,176 +1847,317 @@ def get_mask_from_block_params(image, params, block_cache=None, mask_cache=None,
             mask = np.logical_or(mask1, mask2)
         elif params["operation"] == "xor":
             mask = np.logical_xor(mask1, mask2)
-        add_block(mask_cache, mask, [params])
         return 0, mask
     elif params["operation"] == "coverage":
         if not color_scheme:
             color_scheme = get_color_scheme(image)
-        color_num = get_color(params["params"]["color"], color_scheme["colors"])
+        color_num = get_color(params["params"]["color"], color_scheme["colors"], color_scheme["colors_index"])
         if color_num < 0:
-            add_block(mask_cache, np.array([[]]), [params])
             return 2, None
         status, mask = get_mask_from_max_color_coverage(image, color_num)
         if status != 0:
-            add_block(mask_cache, np.array([[]]), [params])
             return 6, None
-        add_block(mask_cache, mask, [params])
         return 0, mask
     elif params["operation"] == "min_block":
-        status, mask = get_min_block_mask(image)
+        status, mask = get_min_block_mask(image, store=block_cache)
         if status != 0:
-            add_block(mask_cache, np.array([[]]), [params])
             return 6, None
-        add_block(mask_cache, mask, [params])
         return 0, mask
     elif params["operation"] == "max_block":
-        status, mask = get_max_block_mask(image)
+        status, mask = get_max_block_mask(image, store=block_cache)
         if status != 0:
-            add_block(mask_cache, np.array([[]]), [params])
             return 6, None
-        add_block(mask_cache, mask, [params])
         return 0, mask
 
 
+def _immutable(self, *args, **kwargs):
+    raise TypeError("interned params can't be modified")
+
+
+class ParamsDict(dict):
+    """immutable dict of params with the cached hash"""
+
+    __slots__ = ("hash", "__weakref__")
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __hash__(self):
+        return self.hash
+
+    def __reduce__(self):
+        return create_params, (dict(self),)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class ParamsList(list):
+    """immutable list of params with the cached hash"""
+
+    __slots__ = ("hash", "__weakref__")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+    append = extend = insert = pop = remove = clear = sort = reverse = _immutable
+
+    def __hash__(self):
+        return self.hash
+
+    def __reduce__(self):
+        return create_params, (list(self),)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+_interned_params = weakref.WeakValueDictionary()
+# the plain values are hashed together with their types, so True, 1 and 1.0 are different params
+PLAIN_TYPES = {str: "str", int: "int", float: "float", bool: "bool", type(None): "None"}
+
+
+def get_params_key(params):
+    """returns the key of the dict or list of params, the nested params are represented by their hashes"""
+    if isinstance(params, dict):
+        items = [
+            (k, (PLAIN_TYPES[type(v)], v) if type(v) in PLAIN_TYPES else get_params_item(v)) for k, v in params.items()
+        ]
+        return (dict,) + tuple(sorted(items))
+    return (list,) + tuple([(PLAIN_TYPES[type(x)], x) if type(x) in PLAIN_TYPES else get_params_item(x) for x in params])
+
+
+def get_params_item(value):
+    """returns the part of the params key for one value"""
+    value_type = type(value)
+    if value_type is ParamsDict or value_type is ParamsList:
+        return value.hash
+    if isinstance(value, (dict, list, tuple)):
+        return get_dict_hash(value)
+    return PLAIN_TYPES.get(value_type, value_type.__name__), value
+
+
+def intern_params(params):
+    """returns the shared immutable copy of params (dicts and lists of any depth)"""
+    params_type = type(params)
+    if params_type is ParamsDict or params_type is ParamsList:
+        return params
+    if isinstance(params, dict):
+        items = {k: intern_params(v) for k, v in params.items()}
+        container = ParamsDict
+    elif isinstance(params, (list, tuple)):
+        items = [intern_params(x) for x in params]
+        container = ParamsList
+    else:
+        return params
+
+    key = get_params_key(items)
+    result = _interned_params.get(key)
+    if result is None:
+        result = container(items)
+        result.hash = hash(key)
+        _interned_params[key] = result
+    elif result != items:
+        # the key has only the hashes of the nested params, so the params with the same key may differ
+        result = container(items)
+        result.hash = hash(key)
+    return result
+
+
+def create_params(params):
+    """returns the immutable params without looking for the shared copy, the values must be plain or interned"""
+    result = ParamsDict(params) if isinstance(params, dict) else ParamsList(params)
+    result.hash = hash(get_params_key(result))
+    return result
+
+
 def get_dict_hash(d):
-    return hash(json.dumps(d, sort_keys=True))
+    """returns the structural hash of params, the same for equal interned and plain dicts"""
+    d_type = type(d)
+    if d_type is ParamsDict or d_type is ParamsList:
+        return d.hash
+    if isinstance(d, (dict, list, tuple)):
+        return hash(get_params_key(d))
+    return hash(get_params_item(d))
+
+
+# the transforms taking the connected components of the image, which are kept in the blocks store
+COMPONENTS_TRANSFORMS = {"max_block", "min_block", "block_with_side_colors", "block_with_side_colors_count"}
 
 
 def get_predict(image, transforms, block_cache=None, color_scheme=None):
-    """ applies the list of transforms to the image"""
+    """applies the list of transforms to the image, the chains are evaluated along the trie of the transforms in
+    block_cache, so only the steps after the longest known prefix are computed"""
+    if block_cache is None:
+        block_cache = create_block_store()
     params_hash = get_dict_hash(transforms)
     if params_hash in block_cache["params"]:
         if block_cache["params"][params_hash] is None:
+            touch_block(block_cache, params_hash)
             return 1, None
         else:
+            touch_block(block_cache, block_cache["params"][params_hash])
             return 0, block_cache["arrays"][block_cache["params"][params_hash]]["array"]
 
+    # every node of the trie has the hash of its array, the failures are memoized only in the params of the cache,
+    # so they are evicted as the arrays are
+    steps = [get_dict_hash(transform) for transform in transforms]
+    node = block_cache.setdefault("trie", {"children": {}})
+    depth, previous_image = 0, image
+    for step in steps[:-1]:
+        # the nodes of the evicted arrays are removed by evict_block
+        child = node["children"].get(step)
+        if child is None:
+            break
+        node = child
+        depth += 1
+        previous_image = block_cache["arrays"][node["array_hash"]]["array"]
+
     if not color_scheme:
         color_scheme = get_color_scheme(image)
 
-    if len(transforms) > 1:
-        status, previous_image = get_predict(image, transforms[:-1], block_cache=block_cache, color_scheme=color_scheme)
-        if status != 0:
-            return status, None
-    else:
-        previous_image = image
-
-    transform = transforms[-1]
-    function = globals()["get_" + transform["type"]]
-    params = transform.copy()
-    params.pop("type")
-    for color_name in ["color", "color_1", "color_2"]:
-        if color_name in params:
-            params[color_name] = get_color(params[color_name], color_scheme["colors"])
-            if params[color_name] < 0:
-                return 2, None
-    status, result = function(previous_image, **params)
-
-    if status != 0 or len(result) == 0 or len(result[0]) == 0:
-        block_cache["params"][params_hash] = None
-        return 1, None
+    for depth in range(depth + 1, len(transforms) + 1):
+        # the prefixes are hashed the same way as the lists by get_dict_hash
+        prefix_hash = params_hash if depth == len(transforms) else hash((list,) + tuple(steps[:depth]))
+        if prefix_hash in block_cache["params"]:
+            array_hash = block_cache["params"][prefix_hash]
+            if array_hash is None:
+                touch_block(block_cache, prefix_hash)
+                return 1, None
+            node = add_trie_node(block_cache, node, steps[depth - 1], array_hash)
+            touch_block(block_cache, array_hash)
+            previous_image = block_cache["arrays"][array_hash]["array"]
+            continue
+
+        transform = transforms[depth - 1]
+        function = globals()["get_" + transform["type"]]
+        params = transform.copy()
+        params.pop("type")
+        if transform["type"] in COMPONENTS_TRANSFORMS:
+            params["store"] = block_cache
+        for color_name in ["color", "color_1", "color_2"]:
+            if color_name in params:
+                params[color_name] = get_color(params[color_name], color_scheme["colors"], color_scheme["colors_index"])
+                if params[color_name] < 0:
+                    return 2, None
+        status, result = function(previous_image, **params)
+
+        if status != 0 or len(result) == 0 or len(result[0]) == 0:
+            add_cached_failure(block_cache, prefix_hash)
+            return 1, None
 
-    add_block(block_cache, result, [transforms])
-    return 0, result
+        array_hash = add_cached_block(block_cache, result, [transforms[:depth]])
+        node = add_trie_node(block_cache, node, steps[depth - 1], array_hash)
+        previous_image = result
+
+    return 0, previous_image
+
+
+def get_groups_index(groups):
+    """returns the dict from params hashes to the numbers of the groups containing them"""
+    groups_index = {}
+    for n, group in enumerate(groups):
+        for params in group:
+            params_hash = get_dict_hash(params)
+            groups_index[params_hash] = groups_index.get(params_hash, ()) + (n,)
+    return groups_index
+
+
+def find_duplicated_params(first_groups, other_groups_list):
+    """returns hashes of params, that share a group with the previous params of their group in all other images"""
+    groups_indices = [get_groups_index(groups) for groups in other_groups_list]
+
+    duplicated = set()
+    for group in first_groups:
+        # the fingerprint of params is the list of its groups in each of the other images
+        fingerprints = [
+            (params_hash, [groups_index.get(params_hash, ()) for groups_index in groups_indices])
+            for params_hash in map(get_dict_hash, group)
+        ]
+        for (_, fingerprint2), (hash1, fingerprint1) in zip(fingerprints, fingerprints[1:]):
+            if all(
+                groups1 and (groups1 == groups2 or not set(groups1).isdisjoint(groups2))
+                for groups1, groups2 in zip(fingerprint1, fingerprint2)
+            ):
+                duplicated.add(hash1)
+    return duplicated
+
+
+def find_equivalent_params(stores, removed=()):
+    """returns hashes of params, that give the same arrays in all the stores as the previous params with the same
+    array in the first store, the params with the hashes from removed are skipped"""
+    equivalent = set()
+    for data in stores[0]["arrays"].values():
+        fingerprints = set()
+        for params_hash in map(get_dict_hash, data["params"]):
+            if params_hash in removed:
+                continue
+            # the fingerprint of params is the list of its arrays in each of the other images
+            fingerprint = tuple([store["params"].get(params_hash) for store in stores[1:]])
+            if None in fingerprint:
+                continue
+            if fingerprint in fingerprints:
+                equivalent.add(params_hash)
+            else:
+                fingerprints.add(fingerprint)
+    return equivalent
+
+
+def remove_params(groups, hashes):
+    """removes params with the given hashes from all the groups"""
+    if not hashes:
+        return
+    for group in groups:
+        group[:] = [params for params in group if get_dict_hash(params) not in hashes]
 
 
 def filter_colors(sample):
     # filtering colors, that are not present in at least one of the images
-    all_colors = []
-    for color_scheme1 in sample["train"]:
-        list_of_colors = [get_dict_hash(color_dict) for i in range(10) for color_dict in color_scheme1["colors"][i]]
-        all_colors.append(list_of_colors)
-    for j in range(1, len(sample["train"])):
-        all_colors[0] = [x for x in all_colors[0] if x in all_colors[j]]
-    keep_colors = set(all_colors[0])
-
-    for color_scheme1 in sample["train"]:
-        for i in range(10):
-            j = 0
-            while j < len(color_scheme1["colors"][i]):
-                if get_dict_hash(color_scheme1["colors"][i][j]) in keep_colors:
-                    j += 1
-                else:
-                    del color_scheme1["colors"][i][j]
-
-    delete_colors = []
-    color_scheme0 = sample["train"][0]
-    for i in range(10):
-        if len(color_scheme0["colors"][i]) > 1:
-            for j, color_dict1 in enumerate(color_scheme0["colors"][i][::-1][:-1]):
-                hash1 = get_dict_hash(color_dict1)
-                delete = True
-                for color_dict2 in color_scheme0["colors"][i][::-1][j + 1 :]:
-                    hash2 = get_dict_hash(color_dict2)
-                    for color_scheme1 in list(sample["train"][1:]) + list(sample["test"]):
-                        found = False
-                        for k in range(10):
-                            hash_array = [get_dict_hash(color_dict) for color_dict in color_scheme1["colors"][k]]
-                            if hash1 in hash_array and hash2 in hash_array:
-                                found = True
-                                break
-                        if not found:
-                            delete = False
-                            break
-                    if delete:
-                        delete_colors.append(hash1)
-                        break
-
-    for color_scheme1 in sample["train"]:
-        for i in range(10):
-            j = 0
-            while j < len(color_scheme1["colors"][i]):
-                if get_dict_hash(color_scheme1["colors"][i][j]) in delete_colors:
-                    del color_scheme1["colors"][i][j]
-                else:
-                    j += 1
+    keep_colors = set.intersection(
+        *[{get_dict_hash(color_dict) for color in x["colors"] for color_dict in color} for x in sample["train"]]
+    )
+    for color_scheme in sample["train"]:
+        for color in color_scheme["colors"]:
+            color[:] = [color_dict for color_dict in color if get_dict_hash(color_dict) in keep_colors]
+
+    delete_colors = find_duplicated_params(
+        sample["train"][0]["colors"], [x["colors"] for x in list(sample["train"][1:]) + list(sample["test"])]
+    )
+    for color_scheme in sample["train"]:
+        remove_params(color_scheme["colors"], delete_colors)
+        color_scheme["colors_index"] = get_colors_index(color_scheme["colors"])
     return
 
 
 def filter_blocks(sample, arrays_type="blocks"):
-    delete_blocks = []
-    list_of_lists_of_sets = []
-    for arrays_list in [x[arrays_type]["arrays"].values() for x in sample["train"][1:]] + [
-        x[arrays_type]["arrays"].values() for x in sample["test"]
-    ]:
-        list_of_lists_of_sets.append([])
-        for array in arrays_list:
-            list_of_lists_of_sets[-1].append({get_dict_hash(params_dict) for params_dict in array["params"]})
-
-    for initial_array in sample["train"][0][arrays_type]["arrays"].values():
-        if len(initial_array["params"]) > 1:
-            for j, params_dict1 in enumerate(initial_array["params"][::-1][:-1]):
-                hash1 = get_dict_hash(params_dict1)
-                delete = True
-                for params_dict1 in initial_array["params"][::-1][j + 1 :]:
-                    hash2 = get_dict_hash(params_dict1)
-                    for lists_of_sets in list_of_lists_of_sets:
-                        found = False
-                        for hash_set in lists_of_sets:
-                            if hash1 in hash_set and hash2 in hash_set:
-                                found = True
-                                break
-                        if not found:
-                            delete = False
-                            break
-                    if delete:
-                        delete_blocks.append(hash1)
-                        break
-
-    for arrays_list in [x[arrays_type]["arrays"].values() for x in sample["train"]] + [
-        x[arrays_type]["arrays"].values() for x in sample["test"]
-    ]:
-        for array in arrays_list:
-            params_list = array["params"]
-            j = 0
-            while j < len(params_list):
-                if get_dict_hash(params_list[j]) in delete_blocks:
-                    del params_list[j]
-                else:
-                    j += 1
+    delete_blocks = find_filtered_params(sample, arrays_type)
+    for x in list(sample["train"]) + list(sample["test"]):
+        remove_params([array["params"] for array in x[arrays_type]["arrays"].values()], delete_blocks)
     return
 
 
+def find_filtered_params(sample, arrays_type="blocks"):
+    """returns hashes of params removed by filter_blocks without changing the sample, the params are removed only
+    because of the previous params of their groups, so the params of the blocks generated so far are removed in the
+    same way as after all the stages"""
+    delete_blocks = find_duplicated_params(
+        [array["params"] for array in sample["train"][0][arrays_type]["arrays"].values()],
+        [
+            [array["params"] for array in x[arrays_type]["arrays"].values()]
+            for x in list(sample["train"][1:]) + list(sample["test"])
+        ],
+    )
+
+    # the chains giving the same arrays for all the images are interchangeable, so only the first one is kept
+    delete_blocks |= find_equivalent_params(
+        [x[arrays_type] for x in list(sample["train"]) + list(sample["test"])], delete_blocks
+    )
+    return delete_blocks
+
+
 def extract_target_blocks(sample, color_params=None):
     target_blocks_cache = []
     params = ["initial", "block_with_side_colors", "min_max_blocks", "max_area_covered", "cut_parts"]
@@ -1274,41 +2181,516 @@ def extract_target_blocks(sample, color_params=None):
             add_block(sample["test"][n]["blocks"], target_blocks_cache[0]["blocks"]["arrays"][key]["array"], params_list)
 
 
-def preprocess_sample(sample, params=None, color_params=None, process_whole_ds=False):
-    """ make the whole preprocessing for particular sample"""
+# types of the steps of the block chains produced by each of the blocks params
+BLOCKS_PARAMS_TYPES = {
+    "initial": ["original", "inversed_colors"],
+    "background": ["background"],
+    "min_max_blocks": ["max_block"],
+    "block_with_side_colors": ["block_with_side_colors", "block_with_side_colors_count"],
+    "max_area_covered": ["color_max"],
+    "grid_cells": ["grid"],
+    "halves": ["half"],
+    "pixels": ["pixel"],
+    "pixel_fixed": ["pixel_fixed"],
+    "k_part": ["k_part"],
+    "corners": ["corner"],
+    "rotate": ["rotation"],
+    "transpose": ["transpose"],
+    "cut_edges": ["cut_edge"],
+    "resize": ["resize", "resize_to"],
+    "reflect": ["reflect"],
+    "cut_parts": ["cut"],
+    "swap_colors": ["color_swap"],
+    "target": ["target"],
+}
+
+# operations of the masks produced by each of the masks params,
+# the block types and the mask operations have the same names, so they are kept apart
+MASKS_PARAMS_TYPES = {
+    "initial_masks": ["none", "not"],
+    "additional_masks": ["and", "or", "xor"],
+    "coverage_masks": ["coverage"],
+    "min_max_masks": ["min_block", "max_block"],
+}
+
+
+def get_blocks_params_key(params):
+    """returns the key of the blocks generated for params, the params differing only in the masks params give the
+    same blocks"""
+    return frozenset([param for param in params if param not in DEFAULT_MASKS_PARAMS])
+
+
+def copy_sample_stores(sample):
+    """returns the copy of the preprocessed sample, which has its own colors and blocks stores, the arrays are
+    shared"""
+    result = {key: value for key, value in sample.items() if key not in ["train", "test"]}
+    for key in ["train", "test"]:
+        result[key] = []
+        for item in sample[key]:
+            item = item.copy()
+            item["colors"] = [color.copy() for color in item["colors"]]
+            item["colors_index"] = get_colors_index(item["colors"])
+            if "work_budget" in item:
+                item["work_budget"] = dict(item["work_budget"], stages=item["work_budget"]["stages"].copy())
+            item["blocks"] = {
+                "arrays": {
+                    array_hash: {"array": data["array"], "params": data["params"].copy()}
+                    for array_hash, data in item["blocks"]["arrays"].items()
+                },
+                "params": item["blocks"]["params"].copy(),
+            }
+            result[key].append(item)
+    return result
 
-    for n, image in enumerate(sample["train"]):
-        original_image = np.uint8(image["input"])
-        target_image = np.uint8(sample["train"][n]["output"])
-        sample["train"][n].update(get_color_scheme(original_image, target_image=target_image, params=color_params))
-    for n, image in enumerate(sample["test"]):
-        original_image = np.uint8(image["input"])
-        sample["test"][n].update(get_color_scheme(original_image, params=color_params))
 
-    filter_colors(sample)
+def preprocess_sample_for_params(
+    sample,
+    params_list,
+    color_params=None,
+    process_whole_ds=False,
+    cache_dir=None,
+    max_work=None,
+    processes=None,
+    prune_by_target=False,
+):
+    """returns the samples preprocessed for each params of params_list, the colors are made once, the blocks are made
+    once for the common stages of the params and only the masks are made for each of them, so every sample is the
+    same as the one made by preprocess_sample with its params"""
+    params_list = [params or DEFAULT_BLOCKS_PARAMS + DEFAULT_MASKS_PARAMS for params in params_list]
+    paths = [None] * len(params_list)
+    samples = [None] * len(params_list)
+    if cache_dir is not None:
+        # the samples are saved as the ones of preprocess_sample_with_cache, so they are shared with its runs
+        for n, params in enumerate(params_list):
+            paths[n] = get_sample_cache_path(
+                sample,
+                cache_dir,
+                params,
+                color_params,
+                process_whole_ds,
+                max_work=max_work,
+                prune_by_target=prune_by_target,
+            )
+            if os.path.exists(paths[n]):
+                samples[n] = load_sample(paths[n])
 
-    for n, image in enumerate(sample["train"]):
-        original_image = np.uint8(image["input"])
-        target_image = np.uint8(sample["train"][n]["output"])
-        sample["train"][n].update(
-            generate_blocks(original_image, sample["train"][n], target_image=target_image, params=params)
+    groups = {}
+    for n, params in enumerate(params_list):
+        if samples[n] is None:
+            groups.setdefault(get_blocks_params_key(params), []).append(n)
+
+    pool = multiprocessing.Pool(processes) if processes and groups else None
+    try:
+        if max_work is not None or prune_by_target:
+            # the work budget and the target pruning depend on all the stages of the params,
+            # so only the same blocks params share their blocks
+            blocks_samples = {}
+            for key, indices in groups.items():
+                blocks_samples[key] = copy_raw_sample(sample)
+                preprocess_sample_blocks(
+                    blocks_samples[key],
+                    params_list[indices[0]],
+                    color_params,
+                    max_work=max_work,
+                    pool=pool,
+                    prune_by_target=prune_by_target,
+                )
+        else:
+            blocks_samples = preprocess_blocks_for_params(
+                sample, [params_list[indices[0]] for indices in groups.values()], color_params, pool
+            )
+            blocks_samples = dict(zip(groups, blocks_samples))
+
+        for key, indices in groups.items():
+            for n in indices:
+                samples[n] = copy_sample_stores(blocks_samples[key])
+                preprocess_images(samples[n], "masks", pool, params=params_list[n], max_work=max_work)
+                if paths[n] is not None and not is_cut_short(samples[n]):
+                    os.makedirs(cache_dir, exist_ok=True)
+                    save_sample(samples[n], paths[n])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return samples
+
+
+def copy_raw_sample(sample):
+    """returns the copy of the sample, which items can get the keys of the preprocessing"""
+    result = {key: value for key, value in sample.items() if key not in ["train", "test"]}
+    result.update({key: [item.copy() for item in sample[key]] for key in ["train", "test"]})
+    return result
+
+
+def get_derived_stages(params):
+    """returns the derived stages of params in the order they are run"""
+    return tuple(stage for stage in DERIVED_STAGES_WORK if stage in params)
+
+
+def preprocess_blocks_for_params(sample, params_list, color_params=None, pool=None):
+    """returns the samples with the filtered blocks of each params of params_list, every derived stage transforms all
+    the blocks made before it, so the blocks of the params with the same seed stages are made along the trie of their
+    derived stages and each common prefix is made once"""
+    colors_sample = copy_raw_sample(sample)
+    preprocess_images(colors_sample, "colors", pool, params=color_params)
+    filter_colors(colors_sample)
+
+    seed_groups = {}
+    for n, params in enumerate(params_list):
+        seed_params = frozenset(param for param in params if param not in DERIVED_STAGES_WORK)
+        seed_groups.setdefault(seed_params, []).append(n)
+
+    result = [None] * len(params_list)
+    for seed_params, indices in seed_groups.items():
+        root = copy_raw_sample(colors_sample)
+        preprocess_images(root, "extend_blocks", pool, params=list(seed_params), seed=True)
+
+        # the stages sequences are sorted, so the longest prefix shared with the later ones is shared with the next one
+        stages_list = sorted({get_derived_stages(params_list[n]) for n in indices}, key=get_stages_order)
+        shared = set()
+        for stages, next_stages in zip(stages_list, stages_list[1:]):
+            size = 0
+            while size < min(len(stages), len(next_stages)) and stages[size] == next_stages[size]:
+                size += 1
+            shared.add(stages[:size])
+
+        snapshots = {(): root}
+        blocks_samples = {}
+        for stages in stages_list:
+            start = max([prefix for prefix in snapshots if stages[: len(prefix)] == prefix], key=len)
+            blocks_sample = copy_sample_stores(snapshots[start])
+            done = len(start)
+            for end in range(len(start) + 1, len(stages) + 1):
+                if stages[:end] not in shared and end < len(stages):
+                    continue
+                preprocess_images(blocks_sample, "extend_blocks", pool, params=list(stages[done:end]))
+                done = end
+                if stages[:end] in shared:
+                    snapshots[stages[:end]] = copy_sample_stores(blocks_sample)
+            blocks_samples[stages] = blocks_sample
+
+        for n in indices:
+            blocks_sample = blocks_samples[get_derived_stages(params_list[n])]
+            if "target" in params_list[n]:
+                extract_target_blocks(blocks_sample, color_params)
+            filter_blocks(blocks_sample)
+            result[n] = blocks_sample
+    return result
+
+
+def get_stages_order(stages):
+    """returns the key sorting the sequences of the derived stages"""
+    order = list(DERIVED_STAGES_WORK)
+    return [order.index(stage) for stage in stages]
+
+
+def preprocess_image(stage, image, item, target_image=None, kwargs=None):
+    """runs one of the per-image stages of preprocess_sample and returns the new keys of the item"""
+    kwargs = kwargs or {}
+    if stage == "colors":
+        return get_color_scheme(image, target_image=target_image, **kwargs)
+    if stage == "blocks":
+        return generate_blocks(image, item, target_image=target_image, **kwargs)
+    if stage == "extend_blocks":
+        return extend_blocks(image, item, **kwargs)
+    result = generate_masks(image, item, target_image=target_image, **kwargs)
+    return {key: result[key] for key in ["masks", "cut_short"] if key in result}
+
+
+def preprocess_images(sample, stage, pool=None, **kwargs):
+    """runs the stage for all the images of the sample, in the pool of workers if it is given"""
+    tasks = []
+    for n, item in enumerate(sample["train"] + sample["test"]):
+        target_image = np.uint8(item["output"]) if n < len(sample["train"]) else None
+        tasks.append((stage, np.uint8(item["input"]), item, target_image, kwargs))
+
+    if pool is None:
+        for task in tasks:
+            task[2].update(preprocess_image(*task))
+        return sample
+
+    for task, result in zip(tasks, pool.starmap(preprocess_image, tasks)):
+        item = task[2]
+        item.update(result)
+        # the indexes keyed by the params hashes are rebuilt, as the workers may have the other hash seeds
+        for key, value in result.items():
+            if isinstance(value, dict) and "arrays" in value and "params" in value:
+                index_block_store(value)
+        if "colors" in result:
+            item["colors_index"] = get_colors_index(item["colors"])
+    return sample
+
+
+def preprocess_sample(
+    sample,
+    params=None,
+    color_params=None,
+    process_whole_ds=False,
+    filter_params=True,
+    max_time=600,
+    max_work=None,
+    processes=None,
+    prune_by_target=False,
+):
+    """make the whole preprocessing for particular sample, the images are processed by the pool of processes
+    if it is given, the filtering of the params of all the images waits for all of them"""
+    pool = multiprocessing.Pool(processes) if processes else None
+    try:
+        preprocess_sample_blocks(
+            sample, params, color_params, filter_params, max_time, max_work, pool, prune_by_target=prune_by_target
         )
-    for n, image in enumerate(sample["test"]):
-        original_image = np.uint8(image["input"])
-        sample["test"][n].update(generate_blocks(original_image, sample["test"][n], params=params))
+        preprocess_images(sample, "masks", pool, params=params, max_time=max_time, max_work=max_work)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
+    return sample
+
+
+def preprocess_sample_blocks(
+    sample,
+    params=None,
+    color_params=None,
+    filter_params=True,
+    max_time=600,
+    max_work=None,
+    pool=None,
+    prune_by_target=False,
+):
+    """makes the colors and the blocks of preprocess_sample, the masks are not made"""
+    preprocess_images(sample, "colors", pool, params=color_params)
+    filter_colors(sample)
+
+    preprocess_images(
+        sample, "blocks", pool, params=params, max_time=max_time, max_work=max_work, prune_by_target=prune_by_target
+    )
     if "target" in params:
         extract_target_blocks(sample, color_params)
-    filter_blocks(sample)
+    if filter_params:
+        filter_blocks(sample)
+    return sample
 
-    for n, image in enumerate(sample["train"]):
-        original_image = np.uint8(image["input"])
-        target_image = np.uint8(sample["train"][n]["output"])
-        sample["train"][n].update(
-            generate_masks(original_image, sample["train"][n], target_image=target_image, params=params)
+
+def preprocess_sample_stages(
+    sample,
+    params=None,
+    color_params=None,
+    process_whole_ds=False,
+    filter_params=True,
+    max_work=None,
+    prune_by_target=False,
+):
+    """yields the name of each stage of the blocks generation and the sample after it, the masks of the intermediate
+    samples are empty, the last sample is named "final" and is the same as the result of preprocess_sample,
+    the sample is changed by the next stages, so it should be used before the next one is requested"""
+    preprocess_images(sample, "colors", params=color_params)
+    filter_colors(sample)
+
+    items = sample["train"] + sample["test"]
+    target_images = [np.uint8(item["output"]) for item in sample["train"]] + [None] * len(sample["test"])
+    stages = [
+        iterate_blocks(
+            np.uint8(item["input"]),
+            item,
+            target_image=target_image,
+            params=params,
+            max_work=max_work,
+            prune_by_target=prune_by_target,
         )
-    for n, image in enumerate(sample["test"]):
-        original_image = np.uint8(image["input"])
-        sample["test"][n].update(generate_masks(original_image, sample["test"][n], params=params))
+        for item, target_image in zip(items, target_images)
+    ]
+    stages_num = 1 + len([stage for stage in DERIVED_TRANSFORMS if stage in (params or DEFAULT_BLOCKS_PARAMS)])
+
+    # all the images have the same stages, so they are generated together
+    for n, names in enumerate(zip(*stages)):
+        if n == stages_num - 1:
+            break
+        for item in items:
+            item["masks"] = create_block_store()
+        yield names[0], sample
+    for images_stages in stages:
+        for _ in images_stages:
+            pass
+
+    if params and "target" in params:
+        extract_target_blocks(sample, color_params)
+    if filter_params:
+        filter_blocks(sample)
+    preprocess_images(sample, "masks", params=params, max_work=max_work)
+    yield "final", sample
+
+
+def get_new_blocks_sample(sample, seen_params, removed=()):
+    """returns the copy of the sample with the train blocks having the params not found in seen_params and removed,
+    the params of the train blocks are added to seen_params, the test blocks and all the masks are empty and are used
+    as caches"""
+    result = {key: value for key, value in sample.items() if key not in ["train", "test"]}
+    for key in ["train", "test"]:
+        result[key] = []
+        for n, item in enumerate(sample[key]):
+            item = item.copy()
+            # the colors are filtered by the predictors, so they are copied to keep the next stages unchanged
+            item["colors"] = [color.copy() for color in item["colors"]]
+            item["colors_index"] = get_colors_index(item["colors"])
+            blocks, item["blocks"], item["masks"] = item["blocks"], create_block_store(), create_block_store()
+            if key == "train":
+                if len(seen_params) <= n:
+                    seen_params.append(set())
+                # the arrays keep the order of the sample, so the candidates are found in the same order
+                for array_hash, data in blocks["arrays"].items():
+                    params_list = [x for x in data["params"] if x.hash not in seen_params[n] and x.hash not in removed]
+                    if params_list:
+                        add_block(item["blocks"], data["array"], params_list, array_hash=array_hash)
+                seen_params[n].update(blocks["params"])
+            result[key].append(item)
+    return result
+
+
+SAMPLE_CACHE_VERSION = 3
 
+
+def is_cut_short(sample):
+    """checks if the generation of any image of the preprocessed sample was cut short by the time limit"""
+    return any(item.get("cut_short") for item in sample["train"] + sample["test"])
+
+
+def get_sample_digest(sample, *args):
+    """returns the digest of the raw sample and the preprocessing params"""
+    data = json.dumps([SAMPLE_CACHE_VERSION, sample, *args], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def get_sample_cache_path(
+    sample,
+    cache_dir,
+    params=None,
+    color_params=None,
+    process_whole_ds=False,
+    filter_params=True,
+    max_time=600,
+    max_work=None,
+    prune_by_target=False,
+):
+    """returns the path of the sample preprocessed by preprocess_sample with the given params in cache_dir"""
+    max_time = get_time_limit(max_time, max_work)
+    digest = get_sample_digest(
+        sample, params, color_params, process_whole_ds, filter_params, max_time, max_work, prune_by_target
+    )
+    return os.path.join(cache_dir, digest + ".sample")
+
+
+def save_sample(sample, path):
+    """saves the preprocessed sample as one binary file with all the arrays and the pickled index of them"""
+    chunks = []
+    offset = 0
+    index = {}
+    for key, value in sample.items():
+        if key not in ["train", "test"]:
+            index[key] = value
+            continue
+        index[key] = []
+        for item in value:
+            item_index = {}
+            for item_key, item_value in item.items():
+                if item_key == "colors_index":
+                    continue
+                if not (isinstance(item_value, dict) and "arrays" in item_value and "params" in item_value):
+                    item_index[item_key] = item_value
+                    continue
+                # params hashes depend on the interpreter, so only the params lists are saved
+                arrays = {}
+                for array_hash, data in item_value["arrays"].items():
+                    array = np.ascontiguousarray(data["array"])
+                    arrays[array_hash] = (offset, array.dtype.str, array.shape, list(data["params"]))
+                    # the arrays are aligned to 8 bytes to be viewed with any dtype
+                    chunks.append(array.tobytes() + bytes(-array.nbytes % 8))
+                    offset += len(chunks[-1])
+                item_index[item_key] = {"store": arrays}
+            index[key].append(item_index)
+
+    # the index and the arrays are written to one temporary file, which is renamed at once,
+    # so the same sample may be saved by several processes and is never read half-written
+    index_bytes = pickle.dumps(index, protocol=pickle.HIGHEST_PROTOCOL)
+    header = len(index_bytes).to_bytes(8, "little") + index_bytes
+    header += bytes(-len(header) % 8)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(header)
+        for chunk in chunks:
+            file.write(chunk)
+    os.replace(temp_path, path)
+
+
+def load_sample(path):
+    """loads the preprocessed sample saved by save_sample, the arrays are memory-mapped"""
+    with open(path, "rb") as file:
+        index_size = int.from_bytes(file.read(8), "little")
+        index = pickle.loads(file.read(index_size))
+    offset = 8 + index_size + (-(8 + index_size) % 8)
+    if os.path.getsize(path) > offset:
+        data = np.asarray(np.memmap(path, dtype=np.uint8, mode="c", offset=offset))
+    else:
+        data = np.zeros(0, dtype=np.uint8)
+
+    sample = {}
+    for key, value in index.items():
+        if key not in ["train", "test"]:
+            sample[key] = value
+            continue
+        sample[key] = []
+        for item_index in value:
+            item = {}
+            for item_key, item_value in item_index.items():
+                if not (isinstance(item_value, dict) and "store" in item_value):
+                    item[item_key] = item_value
+                    continue
+                store = create_block_store()
+                for array_hash, (offset, dtype, shape, params_list) in item_value["store"].items():
+                    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+                    store["arrays"][array_hash] = {
+                        "array": data[offset : offset + size].view(dtype).reshape(shape),
+                        "params": params_list,
+                    }
+                item[item_key] = index_block_store(store)
+            if "colors" in item:
+                item["colors_index"] = get_colors_index(item["colors"])
+            sample[key].append(item)
+    return sample
+
+
+def preprocess_sample_with_cache(
+    sample,
+    cache_dir,
+    params=None,
+    color_params=None,
+    process_whole_ds=False,
+    filter_params=True,
+    max_time=600,
+    max_work=None,
+    processes=None,
+    prune_by_target=False,
+):
+    """loads the preprocessed sample from cache_dir or preprocesses it and saves it there"""
+    path = get_sample_cache_path(
+        sample, cache_dir, params, color_params, process_whole_ds, filter_params, max_time, max_work, prune_by_target
+    )
+    if os.path.exists(path):
+        return load_sample(path)
+
+    sample = preprocess_sample(
+        sample,
+        params=params,
+        color_params=color_params,
+        process_whole_ds=process_whole_ds,
+        filter_params=filter_params,
+        max_time=max_time,
+        max_work=max_work,
+        processes=processes,
+        prune_by_target=prune_by_target,
+    )
+    # the sample cut short by the time limit is not saved, so it is made again by the next runs
+    if not is_cut_short(sample):
+        os.makedirs(cache_dir, exist_ok=True)
+        save_sample(sample, path)
     return sample
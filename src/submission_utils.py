@@ -12,7 +12,14 @@ import pandas as pd
 import psutil
 
 from matplotlib import pyplot as plt
-from src.preprocessing import preprocess_sample
+from src.predictors import call_predictors_stream
+from src.preprocessing import (
+    limit_sample_caches,
+    preprocess_sample,
+    preprocess_sample_for_params,
+    preprocess_sample_stages,
+    preprocess_sample_with_cache,
+)
 from src.utils import matrix2answer, show_sample
 from tqdm.notebook import tqdm
 
@@ -21,6 +28,15 @@ def sigterm_handler(_signo, _stack_frame):
     sys.exit(0)
 
 
+def limit_stages_caches(stages, max_cache_bytes):
+    """yields the stages of preprocess_sample_stages, the caches of the last sample are limited to max_cache_bytes,
+    the predictors use the caches of the other stages only for this stage"""
+    for stage, sample in stages:
+        if stage == "final" and max_cache_bytes is not None:
+            limit_sample_caches([sample], max_cache_bytes)
+        yield stage, sample
+
+
 def process_file(
     file_path,
     PATH,
@@ -31,21 +47,91 @@ def process_file(
     break_after_answer=False,
     queue=None,
     process_whole_ds=False,
+    cache_dir=None,
+    max_work=None,
+    max_cache_bytes=None,
+    prune_by_target=False,
+    stream_stages=False,
 ):
     with open(os.path.join(PATH, file_path), "r") as file:
         sample = json.load(file)
 
     submission_list = []
-    sample = preprocess_sample(
-        sample, params=preprocess_params, color_params=color_params, process_whole_ds=process_whole_ds
-    )
+    # predictors can be given together with their own preprocess_params
+    predictors = [x if isinstance(x, tuple) else (x, preprocess_params) for x in predictors]
+    params_list = [params for _, params in predictors]
+    # the predictors share the preprocessing, so the blocks are pruned only if all of them use the target shape
+    prune_by_target = prune_by_target and all(predictor.allows_target_pruning() for predictor, _ in predictors)
+    if params_list and all(params == params_list[0] for params in params_list):
+        preprocess_params = params_list[0]
+    stages, stream_results = None, None
+    if stream_stages and all(params == preprocess_params for params in params_list):
+        # the predictors are run on each stage of the blocks generation, which stops after all of them give answers,
+        # the stages are not saved to cache_dir
+        stages = preprocess_sample_stages(
+            sample,
+            params=preprocess_params,
+            color_params=color_params,
+            process_whole_ds=process_whole_ds,
+            max_work=max_work,
+            prune_by_target=prune_by_target,
+        )
+        samples = [sample] * len(predictors)
+    elif any(params != preprocess_params for params in params_list):
+        samples = preprocess_sample_for_params(
+            sample,
+            params_list,
+            color_params=color_params,
+            process_whole_ds=process_whole_ds,
+            cache_dir=cache_dir,
+            max_work=max_work,
+            prune_by_target=prune_by_target,
+        )
+    elif cache_dir is None:
+        sample = preprocess_sample(
+            sample,
+            params=preprocess_params,
+            color_params=color_params,
+            process_whole_ds=process_whole_ds,
+            max_work=max_work,
+            prune_by_target=prune_by_target,
+        )
+        samples = [sample] * len(predictors)
+    else:
+        sample = preprocess_sample_with_cache(
+            sample,
+            cache_dir,
+            params=preprocess_params,
+            color_params=color_params,
+            process_whole_ds=process_whole_ds,
+            max_work=max_work,
+            prune_by_target=prune_by_target,
+        )
+        samples = [sample] * len(predictors)
 
     signal.signal(signal.SIGTERM, sigterm_handler)
 
-    for predictor in predictors:
+    if stages is not None:
+        # the stages are generated only until all the predictors give answers
+        try:
+            stream_results = call_predictors_stream(
+                [predictor for predictor, _ in predictors], limit_stages_caches(stages, max_cache_bytes)
+            )
+        except SystemExit:
+            stream_results = []
+    elif max_cache_bytes is not None:
+        # the blocks and masks added by the predictors to the samples are evicted instead of exceeding the memory limit
+        limit_sample_caches(samples, max_cache_bytes)
+
+    for n, ((predictor, _), sample) in enumerate(zip(predictors, samples)):
         try:
             submission_list = []
-            result, answer = predictor(sample)
+            if stream_results is not None:
+                if n >= len(stream_results):
+                    break
+                result, answer = stream_results[n]
+            else:
+                result, answer = predictor(sample)
             if result == 0:
                 if show_results:
                     show_sample(sample)
@@ -84,7 +170,18 @@ def run_parallel(
     timeout=300,
     max_memory_by_process=1.4e10,
     process_whole_ds=False,
+    cache_dir=None,
+    max_work=None,
+    max_cache_bytes=None,
+    prune_by_target=False,
+    stream_stages=False,
 ):
+    # the time and memory limits are checked only for the workers, so the predictors can't start their own pools,
+    # whose processes would be neither counted nor killed with them
+    for predictor in predictors:
+        if (predictor[0] if isinstance(predictor, tuple) else predictor).params.get("processes"):
+            raise ValueError("predictors with params['processes'] can't be run in run_parallel")
+
     process_list = []
     timing_list = []
 
@@ -99,6 +196,11 @@ def run_parallel(
         break_after_answer=break_after_answer,
         queue=queue,
         process_whole_ds=process_whole_ds,
+        cache_dir=cache_dir,
+        max_work=max_work,
+        max_cache_bytes=max_cache_bytes,
+        prune_by_target=prune_by_target,
+        stream_stages=stream_stages,
     )
 
     result = []
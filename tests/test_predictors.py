@@ -340,3 +340,272 @@ def test_predictor():
         ),
     ]:
         assert check(predictor_class, params, file_path, DATA_PATH, preprocessing_params) == True, f"Error in {id}"
+
+
+def test_shared_candidates():
+    sample = {
+        "train": [
+            {"input": [[1, 5, 2], [5, 5, 5], [3, 5, 4]], "output": [[1, 2], [3, 4]]},
+            {"input": [[5, 5, 5], [2, 5, 3], [1, 5, 1]], "output": [[2, 3], [1, 1]]},
+            {"input": [[4, 4, 5], [5, 5, 5], [4, 1, 5]], "output": [[4, 4], [4, 1]]},
+            {"input": [[4, 6, 5], [5, 5, 5], [1, 1, 5]], "output": [[4], [1]]},
+        ],
+        "test": [{"input": [[2, 5, 2], [5, 5, 5], [1, 5, 3]]}],
+    }
+    for missing in [False, True]:
+        answers = []
+        for shared_candidates in [False, True]:
+            predictor = EliminateColor(params={"skip_train": 1})
+            predictor.shared_candidates = shared_candidates
+            calls = []
+            process_one_sample = predictor.process_one_sample
+            predictor.process_one_sample = lambda k, initial=False: calls.append(k) or process_one_sample(k, initial)
+            processed = preprocess_sample(json.loads(json.dumps(sample)), params=["initial"])
+            if missing:
+                # the second train image has no blocks, as if its budget had run out, the candidates of the others
+                # are still checked on it
+                processed["train"][1]["blocks"] = {"arrays": {}, "params": {}}
+            result, answer = predictor(processed)
+            answers.append((result, [[matrix2answer(x) for x in test_answers] for test_answers in answer]))
+
+        # the candidates of each first part of 4 subsets of 3 samples are found once: 9 calls instead of 12
+        assert len(calls) == 9
+        assert answers[0] == answers[1] == (0, [["|22|13|"]])
+
+    # the search of the last sample has no candidates with the color it lacks, but the check of them keeps them
+    sample["train"] = sample["train"][:2] + [{"input": [[1, 2], [3, 4]], "output": [[1, 2], [3, 4]]}]
+    answers = []
+    for shared_candidates in [False, True]:
+        predictor = EliminateColor(params={"skip_train": 1})
+        predictor.shared_candidates = shared_candidates
+        result, answer = predictor(preprocess_sample(json.loads(json.dumps(sample)), params=["initial"]))
+        answers.append((result, [[matrix2answer(x) for x in test_answers] for test_answers in answer]))
+    assert answers[0] == answers[1]
+    assert len(answers[0][1][0]) == 6
+
+
+def test_candidate_store():
+    store = CandidateStore()
+    colors = [[{"type": "abs", "k": k}] for k in range(3)]
+    block = [{"type": "original"}]
+    candidates = store.expand({"block": block, "n": 1}, {"color": colors[0] + colors[1], "fill_color": colors[2]})
+    assert candidates == [
+        {"block": block, "n": 1, "color": colors[0][0], "fill_color": colors[2][0]},
+        {"block": block, "n": 1, "color": colors[1][0], "fill_color": colors[2][0]},
+    ]
+
+    # the equal candidates are found regardless of the objects and the order of the keys
+    local_candidates = [
+        {"color": {"k": 1, "type": "abs"}, "fill_color": colors[2][0], "n": 1, "block": [{"type": "original"}]}
+    ]
+    assert store.intersect(local_candidates, candidates) == candidates[1:]
+    assert store.intersect(candidates, local_candidates) == local_candidates
+    assert store.intersect([{"block": block, "n": 2}], candidates) == []
+    assert store.intersect([{"block": block, "n": True}], [{"block": block, "n": 1}]) == []
+    assert filter_list_of_dicts(local_candidates, candidates) == candidates[1:]
+
+
+def test_early_reject():
+    image = np.uint8([[1, 0], [0, 0]])
+    target_image = np.zeros((4, 4), dtype=np.uint8)
+    target_image[0, 0] = 1
+    predictor = Pattern()
+    predictor.all_patterns = [np.uint8([[1, 0], [0, 0]]), np.uint8([[1, 1], [0, 0]])]
+    params = {"pattern_num": 0, "mask_color": 1, "background_color": 0, "inverse": False, "swap": False}
+    status, prediction = predictor.predict_output(image, params, target_image=target_image)
+    assert status == 0 and (prediction == target_image).all()
+    assert predictor.predict_output(image, dict(params, pattern_num=1), target_image=target_image)[0] == 4
+    target_image[0, 2] = 1
+    assert predictor.predict_output(image, params, target_image=target_image)[0] == 7
+
+    predictor = Fill()
+    params = {"background_color": 0, "fill_color": 2}
+    assert predictor.precheck_output(image, params, np.uint8([[1, 2], [2, 0]]))
+    assert not predictor.precheck_output(image, params, np.uint8([[3, 2], [2, 0]]))
+    assert not predictor.precheck_output(image, params, np.uint8([[1, 2, 0], [2, 0, 0]]))
+
+
+def test_output_prechecks():
+    gravity = {
+        "train": [
+            {"input": [[1, 0, 0], [0, 0, 0], [0, 2, 0]], "output": [[0, 0, 0], [0, 0, 0], [1, 2, 0]]},
+            {"input": [[0, 3, 0], [0, 0, 0], [0, 0, 0]], "output": [[0, 0, 0], [0, 0, 0], [0, 3, 0]]},
+        ],
+        "test": [{"input": [[0, 0, 4], [0, 0, 0], [0, 0, 0]]}],
+    }
+    fill = {
+        "train": [
+            {"input": [[1, 1, 1], [1, 0, 1], [1, 1, 1]], "output": [[1, 1, 1], [1, 4, 1], [1, 1, 1]]},
+            {"input": [[2, 2, 2], [2, 0, 2], [2, 2, 2]], "output": [[2, 2, 2], [2, 4, 2], [2, 2, 2]]},
+        ],
+        "test": [{"input": [[3, 3, 3], [3, 0, 3], [3, 3, 3]]}],
+    }
+    # the output of the first train sample has the color missing in its input
+    recolored = json.loads(json.dumps(gravity))
+    recolored["train"][0]["output"][2][1] = 5
+
+    for predictor_class, sample in [
+        (Gravity, gravity),
+        (GravityBlocks, gravity),
+        (Fill, fill),
+        (Gravity, recolored),
+        (GravityBlocks, recolored),
+    ]:
+        results, calls = [], []
+        for output_prechecks in [(), predictor_class.output_prechecks]:
+            predictor = predictor_class()
+            predictor.output_prechecks = output_prechecks
+            calls.append(0)
+            predict_output = predictor.predict_output
+
+            def count_calls(*args, **kwargs):
+                calls[-1] += 1
+                return predict_output(*args, **kwargs)
+
+            predictor.predict_output = count_calls
+            result, answer = predictor(preprocess_sample(json.loads(json.dumps(sample)), params=["initial"]))
+            results.append((result, answer and [[matrix2answer(x) for x in test_answers] for test_answers in answer]))
+
+        # the prechecks reject only the candidates that predict_output rejects
+        assert results[0] == results[1]
+        if sample is recolored:
+            assert calls[0] > 0 and calls[1] == 0
+
+    predictor = EliminateColor()
+    image = np.uint8([[1, 5, 2], [5, 5, 5]])
+    assert predictor.precheck_output(image, {"color": 5}, np.uint8([[1, 2]]))
+    assert not predictor.precheck_output(image, {"color": 5}, np.uint8([[1, 3]]))
+    assert not predictor.precheck_output(image, {"color": 5}, np.uint8([[1, 2, 2, 1]]))
+
+
+def test_candidates_pool(monkeypatch):
+    sample = {
+        "train": [
+            {"input": [[1, 5, 2], [5, 5, 5], [3, 5, 4]], "output": [[1, 2], [3, 4]]},
+            {"input": [[5, 5, 5], [2, 5, 3], [1, 5, 1]], "output": [[2, 3], [1, 1]]},
+        ],
+        "test": [{"input": [[2, 5, 2], [5, 5, 5], [1, 5, 3]]}],
+    }
+    pool_calls = []
+
+    class SharedPredictor(dict):
+        def __setitem__(self, key, value):
+            pool_calls.append(key)
+            super().__setitem__(key, value)
+
+    monkeypatch.setattr("src.predictors.POOL_PREDICTOR", SharedPredictor())
+    candidates = []
+    for params in [{}, {"processes": 2, "pool_min_candidates": 1}, {"processes": 2, "pool_min_candidates": 10**6}]:
+        predictor = EliminateColor(params=params)
+        result, answer = predictor(preprocess_sample(json.loads(json.dumps(sample)), params=["initial", "rotate"]))
+        assert result == 0
+        assert [[matrix2answer(x) for x in test_answers] for test_answers in answer] == [["|22|13|"]]
+        candidates.append([get_dict_hash(candidate) for candidate in predictor.solution_candidates])
+    assert pool_calls == ["predictor"]
+    assert candidates[0] == candidates[1] == candidates[2]
+
+
+def test_reflect_rotate_roll():
+    image = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    predictor = Predictor(params={"reflect": (True, False), "rotate": 1, "roll": (1, 2)})
+    expected = np.rot90(np.roll(np.roll(image, 1, axis=0), 2, axis=1), 1)[::-1]
+
+    result = predictor.reflect_rotate_roll(image)
+    assert result.dtype == image.dtype
+    assert (result == expected).all()
+    assert (predictor.reflect_rotate_roll(result, inverse=True) == image).all()
+    assert len(predictor.reflect_rotate_roll_index) == 2
+    assert (predictor.reflect_rotate_roll(image + 1) == expected + 1).all()
+    assert len(predictor.reflect_rotate_roll_index) == 2
+
+
+def test_target_pruning():
+    def make_pair(image):
+        image = np.uint8(image)
+        output = np.kron(image == 1, np.rot90(image))
+        return {"input": image.tolist(), "output": output.tolist()}
+
+    sample = {
+        "train": [make_pair([[1, 2, 0], [0, 1, 0], [2, 2, 1]]), make_pair([[0, 1, 1], [2, 0, 0], [1, 2, 0]])],
+        "test": [{"input": [[2, 1, 0], [1, 1, 2], [0, 0, 1]]}],
+    }
+    params = ["initial", "rotate", "initial_masks"]
+    expected = matrix2answer(np.uint8(make_pair(sample["test"][0]["input"])["output"]))
+
+    # the rotated pattern can not have the shape of the output, so it is pruned
+    pruned = preprocess_sample(json.loads(json.dumps(sample)), params=params, prune_by_target=True)
+    assert PatternFromBlocks()(pruned)[0] != 0
+
+    # the preprocessing of process_file is pruned only if all the predictors use the blocks of the target shape
+    predictors = [PatternFromBlocks(), Fill()]
+    prune_by_target = all(predictor.allows_target_pruning() for predictor in predictors)
+    result, answer = predictors[0](
+        preprocess_sample(json.loads(json.dumps(sample)), params=params, prune_by_target=prune_by_target)
+    )
+    assert result == 0 and expected in [matrix2answer(x) for x in answer[0]]
+    assert all(predictor.allows_target_pruning() for predictor in [Fill(), FillLines()])
+    assert not Fill(params={"rotate": 1}).allows_target_pruning()
+
+
+def test_call_stream():
+    sample = {
+        "train": [
+            {"input": [[1, 5, 2], [5, 5, 5], [3, 5, 4]], "output": [[2, 4], [1, 3]]},
+            {"input": [[5, 5, 5], [2, 5, 3], [1, 5, 1]], "output": [[3, 1], [2, 1]]},
+        ],
+        "test": [{"input": [[2, 5, 2], [5, 5, 5], [1, 5, 3]]}],
+    }
+    params = ["initial", "rotate", "cut_edges", "initial_masks"]
+    stages = []
+
+    def record(samples):
+        for stage, stage_sample in samples:
+            stages.append(stage)
+            yield stage, stage_sample
+
+    # the rotated blocks are enough, so the last stages are not generated
+    result, answer = EliminateColor().call_stream(
+        record(preprocess_sample_stages(json.loads(json.dumps(sample)), params=params))
+    )
+    assert result == 0 and [matrix2answer(x) for x in answer[0]] == ["|23|21|"]
+    assert stages == ["seed", "rotate"]
+
+    predictors = [EliminateColor(), Pattern(), PatternFromBlocks()]
+    calls = []
+
+    def record_calls(predictor):
+        init_call = predictor.init_call
+        predictor.init_call = lambda: calls.append((type(predictor).__name__, stages[-1])) or init_call()
+
+    for predictor in predictors:
+        record_calls(predictor)
+    stages.clear()
+    results = call_predictors_stream(
+        predictors, record(preprocess_sample_stages(json.loads(json.dumps(sample)), params=params))
+    )
+    assert results[0][0] == 0 and stages == ["seed", "rotate", "final"]
+    # the pattern is searched only on the first stage and the blocks with masks only on the last one
+    assert calls == [
+        ("EliminateColor", "seed"),
+        ("Pattern", "seed"),
+        ("EliminateColor", "rotate"),
+        ("PatternFromBlocks", "final"),
+    ]
+
+
+def test_call_stream_filtering():
+    # the inputs are symmetric, so the blocks rotated by 90 and 270 degrees are the same and one of them is filtered
+    inputs = [[[1, 5, 2], [5, 5, 5], [2, 5, 1]], [[3, 5, 1], [5, 5, 5], [1, 5, 3]]]
+    sample = {
+        "train": [{"input": x, "output": np.rot90(np.uint8(x)[::2, ::2]).tolist()} for x in inputs],
+        "test": [{"input": [[2, 5, 4], [5, 5, 5], [4, 5, 2]]}],
+    }
+    params = ["initial", "rotate", "cut_edges", "initial_masks"]
+    stages = preprocess_sample_stages(json.loads(json.dumps(sample)), params=params)
+    result, answer = EliminateColor().call_stream(stages)
+
+    # the stream stops after the rotated blocks, so it gives the answers of the sample preprocessed up to them
+    direct = preprocess_sample(json.loads(json.dumps(sample)), params=["initial", "rotate", "initial_masks"])
+    direct_result, direct_answer = EliminateColor()(direct)
+    assert result == direct_result == 0
+    assert [matrix2answer(x) for x in answer[0]] == [matrix2answer(x) for x in direct_answer[0]] == ["|42|24|"]
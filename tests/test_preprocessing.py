@@ -0,0 +1,482 @@
+import src.preprocessing
+from src.preprocessing import *
+
+
+def test_add_block():
+    store = create_block_store()
+    image = np.uint8([[1, 2], [3, 4]])
+    add_block(store, image, [[{"type": "original"}]])
+    add_block(store, image.copy(), [[{"type": "rotation", "k": 0}]])
+    add_block(store, image.T, [[{"type": "transpose"}]])
+    add_block(store, np.uint8([[1, 2, 3, 4]]), [[{"type": "pixels"}]])
+
+    assert len(store["arrays"]) == 3
+    key = get_array_hash(image)
+    assert len(store["arrays"][key]["params"]) == 2
+    assert store["arrays"][key]["array"].flags["C_CONTIGUOUS"]
+    assert store["params"][get_dict_hash([{"type": "transpose"}])] == get_array_hash(image.T)
+    assert store["arrays"][get_array_hash(image.T)]["array"].flags["C_CONTIGUOUS"]
+
+
+def test_intern_params():
+    params = [{"type": "rotation", "k": 1}, {"type": "cut_edge", "l": 1, "r": 0, "t": 0, "b": 0}]
+    interned = intern_params(params)
+
+    assert interned is intern_params([dict(reversed(list(x.items()))) for x in params])
+    assert interned == params
+    assert get_dict_hash(interned) == get_dict_hash(params)
+    assert get_dict_hash(interned) != get_dict_hash(params[::-1])
+    assert intern_params(tuple(params)) is interned
+    assert create_params([intern_params(x) for x in params]).hash == interned.hash
+
+    # the values of different types are different params even if they are equal
+    flags = [{"type": "a", "n": value} for value in [True, 1, 1.0]]
+    assert len({id(x) for x in [intern_params(x) for x in flags]}) == 3
+    assert len({get_dict_hash(x) for x in flags}) == 3
+    assert len({get_dict_hash(x["n"]) for x in flags}) == 3
+
+
+def test_cut_parts():
+    image = np.uint8([[0, 1, 0, 1, 2], [1, 0, 1, 0, 2], [0, 1, 0, 1, 2], [3, 3, 3, 3, 3]])
+    expected = {"blocks": create_block_store()}
+    max_x, max_y = image.shape
+    for x1 in range(0, max_x - 2):
+        for x2 in range(x1 + 2, max_x):
+            for y1 in range(0, max_y - 2):
+                for y2 in range(y1 + 2, max_y):
+                    status, block = get_cut(image, x1, y1, x2, y2)
+                    add_block(expected["blocks"], block, [[{"type": "cut", "x1": x1, "x2": x2, "y1": y1, "y2": y2}]])
+
+    result = {"blocks": create_block_store()}
+    add_cut_parts(image, result, time.time())
+    assert list(result["blocks"]["arrays"]) == list(expected["blocks"]["arrays"])
+    for key, data in expected["blocks"]["arrays"].items():
+        assert (result["blocks"]["arrays"][key]["array"] == data["array"]).all()
+        assert result["blocks"]["arrays"][key]["params"] == data["params"]
+    assert result["blocks"]["params"] == expected["blocks"]["params"]
+
+
+def test_dihedral_image():
+    image = np.uint8([[0, 1, 2], [3, 4, 5]])
+    orbits = {}
+    block_hash, block = get_dihedral_image(orbits, get_array_hash(image), image, (1, False))
+    assert block_hash == get_array_hash(np.rot90(image))
+    for k in range(4):
+        for transpose in [False, True]:
+            _, expected = get_dihedral(np.rot90(image), k, transpose)
+            block_hash, result = get_dihedral_image(orbits, get_array_hash(block), block, (k, transpose))
+            assert (result == expected).all() and block_hash == get_array_hash(expected)
+
+
+def test_components():
+    image = np.uint8([[1, 1, 0, 2], [0, 0, 0, 2], [3, 0, 0, 0]])
+    store = create_block_store()
+    components = get_components(image, [[0, 1, 0], [1, 1, 1], [0, 1, 0]], store=store)
+    assert components is get_components(image.copy(), [[0, 1, 0], [1, 1, 1], [0, 1, 0]], store=store)
+    assert components is not get_components(image, [[0, 1, 0], [1, 1, 1], [0, 1, 0]], store=create_block_store())
+    assert components["n"] == 3
+    assert list(components["sizes"]) == [2, 2, 1]
+    assert (components["histograms"][1] == np.bincount([2, 2], minlength=10)).all()
+
+    status, block = get_min_block(image, full=False, store=store)
+    assert status == 0 and (block == np.uint8([[3]])).all()
+    assert len(store["components"]) == 1
+    status, block = get_max_block(image, full=False)
+    assert status == 0 and (block == np.uint8([[1, 1]])).all()
+
+
+def test_combined_masks():
+    result = {"masks": create_block_store()}
+    add_block(result["masks"], np.array([[True, False], [True, False]]), [{"operation": "a"}])
+    add_block(result["masks"], np.array([[True, True], [False, False]]), [{"operation": "b"}])
+    add_block(result["masks"], np.array([[False, True], [False, True]]), [{"operation": "c"}])
+    add_block(result["masks"], np.array([[True, True, True]]), [{"operation": "d"}])
+    add_combined_masks(result, time.time())
+
+    assert len(result["masks"]["arrays"]) == 12
+    full = result["masks"]["arrays"][get_array_hash(np.ones((2, 2), dtype=bool))]
+    assert [param["operation"] for param in full["params"]] == ["or", "xor"]
+    assert full["params"][0]["params"] == {"mask1": {"operation": "a"}, "mask2": {"operation": "c"}}
+
+
+def test_mask_memo():
+    image = np.uint8([[1, 0], [0, 1]])
+    mask_cache = create_block_store()
+    params = {"operation": "not", "params": {"block": [{"type": "original"}], "color": {"type": "non_zero"}}}
+    missing = {"operation": "not", "params": {"block": [{"type": "original"}], "color": {"type": "abs", "k": 5}}}
+
+    status, mask = get_mask_from_block_params(image, params, mask_cache=mask_cache)
+    assert status == 0 and (mask == (image != 1)).all()
+    assert mask_cache["stats"] == {"hits": 0, "misses": 2}
+    assert get_mask_from_block_params(image, params, mask_cache=mask_cache)[1] is mask
+    assert get_mask_from_block_params(image, missing, mask_cache=mask_cache)[0] != 0
+    assert get_mask_from_block_params(image, missing, mask_cache=mask_cache) == (1, None)
+    assert mask_cache["stats"] == {"hits": 2, "misses": 4}
+
+
+def test_colors_index():
+    image = np.uint8([[0, 0, 3], [0, 5, 5], [0, 0, 0]])
+    color_scheme = get_color_scheme(image)
+    for color_dict in [{"type": "abs", "k": 7}, {"type": "min", "k": 0}, {"type": "max", "k": 0}, {"type": "grid"}]:
+        expected = get_color(color_dict, color_scheme["colors"])
+        assert get_color(color_dict, color_scheme["colors"], color_scheme["colors_index"]) == expected
+    assert get_color({"type": "min", "k": 0}, color_scheme["colors"], color_scheme["colors_index"]) == 3
+
+
+def test_find_duplicated_params():
+    a, b, c, d = [{"type": "abs", "k": k} for k in range(4)]
+    first_groups = [[a, b, c], [d]]
+    other_groups_list = [[[b, c], [a, d]], [[a, b, c]]]
+
+    assert find_duplicated_params(first_groups, other_groups_list) == {get_dict_hash(c)}
+    assert find_duplicated_params(first_groups, []) == {get_dict_hash(b), get_dict_hash(c)}
+
+    groups = [[a, b, c], [c, d]]
+    remove_params(groups, {get_dict_hash(c)})
+    assert groups == [[a, b], [d]]
+
+
+def test_find_equivalent_params():
+    a, b, c, d = [[{"type": "abs", "k": k}] for k in range(4)]
+
+    def get_store(groups):
+        store = {"arrays": {}, "params": {}}
+        for i, group in enumerate(groups):
+            store["arrays"][i] = {"array": np.uint8([[i]]), "params": group}
+            store["params"].update({get_dict_hash(params): i for params in group})
+        return store
+
+    stores = [get_store([[a, b, c], [d]]), get_store([[a, c], [b], [d]]), get_store([[a, b, c, d]])]
+    assert find_equivalent_params(stores) == {get_dict_hash(c)}
+
+    # the params absent in some image are never treated as equivalent
+    stores = [get_store([[a, b, c], [d]]), get_store([[a, c], [d]])]
+    assert find_equivalent_params(stores) == {get_dict_hash(c)}
+    stores = [get_store([[a, b, c]]), get_store([[a], [c]])]
+    assert find_equivalent_params(stores) == set()
+
+
+def test_sample_cache(tmp_path):
+    sample = {
+        "train": [
+            {"input": [[0, 1], [1, 1]], "output": [[1, 0], [0, 0]]},
+            {"input": [[2, 0], [0, 0]], "output": [[0, 2]]},
+        ],
+        "test": [{"input": [[0, 3], [3, 3]]}],
+    }
+    params = ["initial", "rotate", "initial_masks"]
+    cache_dir = str(tmp_path)
+    result = preprocess_sample_with_cache(json.loads(json.dumps(sample)), cache_dir, params=params)
+    cached = preprocess_sample_with_cache(json.loads(json.dumps(sample)), cache_dir, params=params)
+
+    assert [path.suffix for path in tmp_path.iterdir()] == [".sample"]
+    for item, cached_item in zip(result["train"] + result["test"], cached["train"] + cached["test"]):
+        assert cached_item["colors"] == item["colors"]
+        for key in ["blocks", "masks"]:
+            assert cached_item[key]["arrays"].keys() == item[key]["arrays"].keys()
+            for array_hash, data in item[key]["arrays"].items():
+                assert (cached_item[key]["arrays"][array_hash]["array"] == data["array"]).all()
+                assert cached_item[key]["arrays"][array_hash]["params"] == data["params"]
+
+    status, block = get_predict(None, [{"type": "original"}, {"type": "rotation", "k": 1}], cached["test"][0]["blocks"])
+    assert status == 0 and (block == np.rot90(np.uint8(sample["test"][0]["input"]))).all()
+    assert get_color({"type": "abs", "k": 3}, [], cached["test"][0]["colors_index"]) == 3
+
+    # the time limit changes the generated blocks, so it is the part of the key
+    preprocess_sample_with_cache(json.loads(json.dumps(sample)), cache_dir, params=params, max_time=60)
+    assert len(list(tmp_path.iterdir())) == 2
+
+    # the samples cut short by the time limit are not saved
+    cut = preprocess_sample_with_cache(json.loads(json.dumps(sample)), cache_dir, params=params, max_time=0)
+    assert is_cut_short(cut)
+    assert len(list(tmp_path.iterdir())) == 2
+
+    # the samples of preprocess_sample_for_params are shared with preprocess_sample_with_cache
+    params_list = [params, params + ["coverage_masks"]]
+    views = preprocess_sample_for_params(json.loads(json.dumps(sample)), params_list, cache_dir=cache_dir)
+    assert len(list(tmp_path.iterdir())) == 3
+    assert views[0]["test"][0]["blocks"]["arrays"].keys() == result["test"][0]["blocks"]["arrays"].keys()
+
+
+def test_sample_views():
+    sample = {
+        "train": [{"input": [[0, 1, 1], [2, 0, 0]], "output": [[1]]}, {"input": [[3, 1], [1, 0]], "output": [[1]]}],
+        "test": [{"input": [[0, 2], [2, 2]]}],
+    }
+    params_list = [
+        ["initial", "rotate", "initial_masks"],
+        ["initial", "rotate", "additional_masks", "initial_masks"],
+        ["initial", "transpose", "coverage_masks"],
+        ["initial", "rotate", "cut_edges", "initial_masks", "min_max_masks"],
+        ["initial", "rotate", "cut_edges", "reflect", "initial_masks"],
+        ["initial", "rotate", "transpose", "reflect"],
+        ["rotate", "reflect", "initial_masks"],
+        ["initial", "halves", "rotate", "initial_masks"],
+    ]
+    # the resized blocks depend on the scipy version, so they are left out
+    params_list += [["initial", param, "initial_masks"] for param in BLOCKS_PARAMS_TYPES if param not in ["resize"]]
+
+    for max_work in [None, 1000]:
+        views = preprocess_sample_for_params(json.loads(json.dumps(sample)), params_list, max_work=max_work)
+        for params, view in zip(params_list, views):
+            # every view is the same as the sample preprocessed with its own params
+            direct = preprocess_sample(json.loads(json.dumps(sample)), params=params, max_work=max_work)
+            for item, view_item in zip(direct["train"] + direct["test"], view["train"] + view["test"]):
+                assert view_item["colors"] == item["colors"]
+                for key in ["blocks", "masks"]:
+                    assert list(view_item[key]["arrays"]) == list(item[key]["arrays"])
+                    assert view_item[key]["params"] == item[key]["params"]
+                    for array_hash, data in item[key]["arrays"].items():
+                        assert view_item[key]["arrays"][array_hash]["params"] == data["params"]
+
+    # the views with the same blocks params share the arrays, but not the stores changed by the predictors
+    assert views[0]["test"][0]["blocks"] is not views[1]["test"][0]["blocks"]
+    key = next(iter(views[0]["test"][0]["blocks"]["arrays"]))
+    arrays = [view["test"][0]["blocks"]["arrays"][key] for view in views[:2]]
+    assert arrays[0]["array"] is arrays[1]["array"] and arrays[0]["params"] is not arrays[1]["params"]
+
+
+def test_shared_stages(monkeypatch):
+    sample = {"train": [{"input": [[0, 1, 1], [2, 0, 0]], "output": [[1]]}], "test": [{"input": [[0, 2], [2, 2]]}]}
+    calls = []
+
+    def get_rotations(orbits, key, image, element):
+        calls.append(element)
+        return get_dihedral_image(orbits, key, image, element)
+
+    monkeypatch.setattr(src.preprocessing, "get_dihedral_image", get_rotations)
+    preprocess_sample_for_params(json.loads(json.dumps(sample)), [["initial", "rotate"]])
+    rotations = len(calls)
+
+    # the blocks of the common stages are made once for the params containing them
+    calls.clear()
+    params_list = [["initial", "rotate"], ["initial", "rotate", "cut_edges"], ["initial", "rotate", "reflect"]]
+    views = preprocess_sample_for_params(json.loads(json.dumps(sample)), params_list)
+    assert len(calls) == rotations
+    direct = preprocess_sample(json.loads(json.dumps(sample)), params=params_list[1])
+    assert list(views[1]["test"][0]["blocks"]["arrays"]) == list(direct["test"][0]["blocks"]["arrays"])
+
+
+def test_work_budget(monkeypatch):
+    image = np.uint8([[0, 1, 2], [3, 4, 5], [1, 1, 0]])
+    params = ["initial", "rotate", "cut_edges", "cut_parts", "swap_colors"]
+    initial = generate_blocks(image, get_color_scheme(image), params=["initial"])
+    assert create_work_budget(None, image, initial, params) is None
+
+    charged = []
+
+    def charge(budget, stage, image, store):
+        status = spend_work(budget, stage, image, store)
+        if status and budget is not None:
+            charged.append((stage, budget))
+        return status
+
+    monkeypatch.setattr(src.preprocessing, "spend_work", charge)
+    for max_work in [0, 100, 1000, 10000]:
+        charged.clear()
+        result = generate_blocks(image, get_color_scheme(image), params=params, max_work=max_work)
+        result = generate_masks(image, result, params=DEFAULT_MASKS_PARAMS, max_work=max_work)
+
+        # every stage that gave blocks or masks is charged and the work of all of them fits into one budget
+        assert len({id(budget) for _, budget in charged}) <= 1
+        assert all(budget["work"] <= max_work for _, budget in charged)
+        stages = ["initial"] + [stage for stage, _ in charged]
+        steps = {step["type"] for data in result["blocks"]["arrays"].values() for x in data["params"] for step in x}
+        assert steps <= {x for stage in stages for x in BLOCKS_PARAMS_TYPES.get(stage, [])}
+        operations = {x["operation"] for data in result["masks"]["arrays"].values() for x in data["params"]}
+        assert operations <= {x for stage in stages for x in MASKS_PARAMS_TYPES.get(stage, [])}
+        rerun = generate_blocks(image, get_color_scheme(image), params=params, max_work=max_work)
+        assert result["blocks"]["arrays"].keys() == rerun["blocks"]["arrays"].keys()
+    assert {stage for stage, _ in charged} >= {"coverage_masks", "min_max_masks"}
+    monkeypatch.undo()
+
+    # the masks with the most new masks per work are chosen first
+    result = generate_blocks(image, get_color_scheme(image), params=["initial"], max_work=150)
+    masks_params = ["coverage_masks", "min_max_masks"]
+    assert add_masks_stages(result["work_budget"], image, result, masks_params)["stages"] == ["min_max_masks"]
+
+    # the same work budget gives the same blocks and masks under any time limit
+    sample = {"train": [{"input": image.tolist(), "output": [[1]]}], "test": [{"input": [[0, 2], [2, 2]]}]}
+    sample_params = params + DEFAULT_MASKS_PARAMS
+    timed = preprocess_sample(json.loads(json.dumps(sample)), params=sample_params, max_time=0, max_work=1000)
+    direct = preprocess_sample(json.loads(json.dumps(sample)), params=sample_params, max_work=1000)
+    assert not is_cut_short(timed)
+    for item, timed_item in zip(direct["train"] + direct["test"], timed["train"] + timed["test"]):
+        for key in ["blocks", "masks"]:
+            assert list(timed_item[key]["arrays"]) == list(item[key]["arrays"])
+            assert timed_item[key]["params"] == item[key]["params"]
+
+    unlimited = generate_blocks(image, get_color_scheme(image), params=params, max_work=None)
+    default = generate_blocks(image, get_color_scheme(image), params=params)
+    assert unlimited["blocks"]["arrays"].keys() == default["blocks"]["arrays"].keys()
+
+
+def test_parallel_preprocessing():
+    sample = {
+        "train": [{"input": [[0, 1, 1], [2, 0, 0]], "output": [[1]]}, {"input": [[3, 1], [1, 0]], "output": [[1]]}],
+        "test": [{"input": [[0, 2], [2, 2]]}],
+    }
+    params = ["initial", "rotate", "cut_edges", "initial_masks"]
+    result = preprocess_sample(json.loads(json.dumps(sample)), params=params)
+    parallel = preprocess_sample(json.loads(json.dumps(sample)), params=params, processes=2)
+
+    for item, parallel_item in zip(result["train"] + result["test"], parallel["train"] + parallel["test"]):
+        assert parallel_item["colors"] == item["colors"]
+        assert parallel_item["colors_index"].keys() == item["colors_index"].keys()
+        for key in ["blocks", "masks"]:
+            assert parallel_item[key]["params"] == item[key]["params"]
+            for array_hash, data in item[key]["arrays"].items():
+                assert (parallel_item[key]["arrays"][array_hash]["array"] == data["array"]).all()
+                assert parallel_item[key]["arrays"][array_hash]["params"] == data["params"]
+
+
+def test_cache_limit():
+    image = np.uint8([[0, 1, 2], [3, 4, 5]])
+    item = {"blocks": create_block_store(), "masks": create_block_store()}
+    add_block(item["blocks"], image, [[{"type": "original"}]])
+    budget = limit_sample_caches([{"train": [item], "test": []}], 13)
+
+    rotation = [{"type": "original"}, {"type": "rotation", "k": 1}]
+    get_predict(image, rotation, item["blocks"])
+    get_predict(image, [{"type": "original"}, {"type": "rotation", "k": 2}], item["blocks"])
+    get_predict(image, rotation, item["blocks"])
+    assert budget["bytes"] == 12 and budget["evicted"] == 0
+
+    get_predict(image, [{"type": "original"}, {"type": "transpose"}], item["blocks"])
+    assert budget["bytes"] == 12 and budget["evicted"] == 1
+    assert get_array_hash(image) in item["blocks"]["arrays"]
+    assert get_dict_hash(rotation) in item["blocks"]["params"]
+    assert get_dict_hash([{"type": "original"}, {"type": "rotation", "k": 2}]) not in item["blocks"]["params"]
+
+    # the views of the same sample share one budget, the failures are evicted as the arrays
+    views = [{"train": [{"blocks": create_block_store(), "masks": create_block_store()}], "test": []} for _ in range(2)]
+    for view in views:
+        add_block(view["train"][0]["blocks"], image, [[{"type": "original"}]])
+    blocks, other_blocks = views[0]["train"][0]["blocks"], views[1]["train"][0]["blocks"]
+    budget = limit_sample_caches(views, 12)
+    get_predict(image, rotation, blocks)
+    get_predict(image, [{"type": "original"}, {"type": "transpose"}], other_blocks)
+    get_predict(image, [{"type": "original"}, {"type": "rotation", "k": 2}], other_blocks)
+    assert budget["bytes"] == 12 and budget["evicted"] == 1
+    assert get_dict_hash(rotation) not in blocks["params"]
+
+    budget["max_bytes"] = 12 + FAILURE_BYTES
+    cut = [{"type": "original"}, {"type": "cut_edge", "l": 3, "r": 0, "t": 0, "b": 0}]
+    assert get_predict(image, cut, blocks) == (1, None)
+    assert budget["bytes"] == 12 + FAILURE_BYTES and blocks["params"][get_dict_hash(cut)] is None
+    mask_params = {"operation": "none", "params": {"block": [{"type": "original"}], "color": {"type": "abs", "k": 9}}}
+    assert get_mask_from_block_params(image, mask_params, blocks, views[0]["train"][0]["masks"])[0] != 0
+    assert budget["bytes"] == FAILURE_BYTES and budget["evicted"] == 4
+    assert get_dict_hash(cut) not in blocks["params"]
+    assert views[0]["train"][0]["masks"]["params"][get_dict_hash(mask_params)] is None
+
+
+def test_pinned_caches():
+    image = np.uint8([[0, 1, 2], [3, 4, 5]])
+    items = [{"blocks": create_block_store(), "masks": create_block_store()} for _ in range(2)]
+    for item in items:
+        add_block(item["blocks"], image, [[{"type": "original"}]])
+    blocks, other_blocks = items[0]["blocks"], items[1]["blocks"]
+    budget = limit_sample_caches([{"train": items, "test": []}], 12)
+    original, rotation = {"type": "original"}, {"type": "rotation", "k": 1}
+    get_predict(image, [original, rotation], blocks)
+
+    # the pinned blocks are iterated while the other blocks exceed the budget
+    pin_caches(items[0])
+    for _ in blocks["arrays"].items():
+        get_predict(image, [original, {"type": "transpose"}], other_blocks)
+        get_predict(image, [original, {"type": "rotation", "k": 2}], other_blocks)
+    assert budget["bytes"] == 12 and get_dict_hash([original, rotation]) in blocks["params"]
+
+    # the entries put aside are evicted first after the blocks are unpinned, together with their trie nodes
+    budget["max_bytes"] = 6
+    unpin_caches(items[0])
+    assert budget["bytes"] == 6 and get_dict_hash([original, rotation]) not in blocks["params"]
+    assert get_dict_hash(rotation) not in blocks["trie"]["children"][get_dict_hash(original)]["children"]
+    assert get_array_hash(np.rot90(image)) not in blocks["trie_nodes"]
+    status, block = get_predict(image, [original, rotation], blocks)
+    assert status == 0 and (block == np.rot90(image)).all()
+
+
+def test_transforms_trie():
+    image = np.uint8([[0, 1, 2], [3, 4, 5]])
+    block_cache = create_block_store()
+    rotation, transpose = {"type": "rotation", "k": 1}, {"type": "transpose"}
+    status, block = get_predict(image, [{"type": "original"}, rotation, transpose], block_cache)
+    assert status == 0 and (block == np.rot90(image).T).all()
+    assert len(block_cache["arrays"]) == 3
+
+    node = block_cache["trie"]["children"][get_dict_hash({"type": "original"})]["children"][get_dict_hash(rotation)]
+    assert node["array_hash"] == get_array_hash(np.rot90(image))
+    status, block = get_predict(image, [{"type": "original"}, rotation, rotation], block_cache)
+    assert status == 0 and (block == np.rot90(image, 2)).all()
+    assert len(node["children"]) == 2
+
+    cut = {"type": "cut_edge", "l": 3, "r": 0, "t": 0, "b": 0}
+    assert get_predict(image, [{"type": "original"}, cut], block_cache) == (1, None)
+    assert get_predict(image, [{"type": "original"}, cut, rotation], block_cache) == (1, None)
+    assert block_cache["params"][get_dict_hash([{"type": "original"}, cut])] is None
+    assert get_dict_hash(cut) not in block_cache["trie"]["children"][get_dict_hash({"type": "original"})]["children"]
+
+
+def test_normalize_params():
+    rotation, transpose = {"type": "rotation", "k": 1}, {"type": "transpose"}
+    cut = {"type": "cut_edge", "l": 1, "r": 0, "t": 0, "b": 0}
+    assert normalize_params([{"type": "original"}, rotation, {"type": "rotation", "k": 3}]) == [{"type": "original"}]
+    assert normalize_params([{"type": "original"}, transpose, transpose, cut, cut]) == [
+        {"type": "original"},
+        {"type": "cut_edge", "l": 2, "r": 0, "t": 0, "b": 0},
+    ]
+
+    image = np.uint8([[0, 1, 2, 3], [4, 5, 6, 7], [8, 9, 1, 2]])
+    params = [{"type": "original"}, rotation, cut, {"type": "reflect", "side": "rt"}]
+    normalized = normalize_params(params)
+    assert [step["type"] for step in normalized] == ["original", "cut_edge", "reflect", "rotation"]
+    assert (get_predict(image, normalized)[1] == get_predict(image, params)[1]).all()
+
+
+def test_prune_by_target():
+    image = np.uint8([[0, 1, 2, 3], [4, 5, 6, 7], [8, 9, 1, 2], [3, 4, 5, 6]])
+    target_image = np.zeros((2, 3), dtype=np.uint8)
+    params = ["initial", "rotate", "cut_edges", "reflect", "cut_parts"]
+    assert get_transform_shape((4, 3), {"type": "reflect", "side": "rt"}) == (7, 5)
+    assert get_transform_shape((4, 3), {"type": "cut_edge", "l": 1, "r": 1, "t": 1, "b": 1}) == (2, 1)
+
+    full = generate_blocks(image, get_color_scheme(image), target_image=target_image, params=params)
+    pruned = generate_blocks(
+        image, get_color_scheme(image), target_image=target_image, params=params, prune_by_target=True
+    )
+    assert len(pruned["blocks"]["arrays"]) < len(full["blocks"]["arrays"])
+    for key, data in full["blocks"]["arrays"].items():
+        if data["array"].shape == target_image.shape:
+            assert pruned["blocks"]["arrays"][key]["params"] == data["params"]
+
+
+def test_sample_stages():
+    sample = {
+        "train": [{"input": [[0, 1, 1], [2, 0, 0]], "output": [[1]]}, {"input": [[3, 1], [1, 0]], "output": [[1]]}],
+        "test": [{"input": [[0, 2], [2, 2]]}],
+    }
+    params = ["initial", "rotate", "cut_edges", "initial_masks"]
+    stages = preprocess_sample_stages(json.loads(json.dumps(sample)), params=params)
+    stage, seed = next(stages)
+    steps = {step["type"] for data in seed["test"][0]["blocks"]["arrays"].values() for x in data["params"] for step in x}
+    assert stage == "seed" and steps == {"original", "inversed_colors"}
+    assert not seed["test"][0]["masks"]["arrays"]
+
+    seen_params = []
+    new_blocks = get_new_blocks_sample(seed, seen_params)
+    assert new_blocks["train"][0]["blocks"]["params"] == seed["train"][0]["blocks"]["params"]
+    assert not new_blocks["test"][0]["blocks"]["arrays"]
+    stage, rotated = next(stages)
+    new_blocks = get_new_blocks_sample(rotated, seen_params)
+    steps = {x[-1]["type"] for data in new_blocks["train"][0]["blocks"]["arrays"].values() for x in data["params"]}
+    assert stage == "rotate" and steps == {"rotation"}
+    assert [stage for stage, _ in stages] == ["final"]
+
+    result = preprocess_sample(json.loads(json.dumps(sample)), params=params)
+    for item, streamed_item in zip(result["train"] + result["test"], seed["train"] + seed["test"]):
+        for key in ["blocks", "masks"]:
+            assert streamed_item[key]["params"] == item[key]["params"]
+            for array_hash, data in item[key]["arrays"].items():
+                assert streamed_item[key]["arrays"][array_hash]["params"] == data["params"]